@@ -0,0 +1,132 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import logging
+import numpy as np
+from embeddings import EMBEDDINGS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Число итераций k-means при построении списков
+KMEANS_ITERATIONS = 10
+# Меньше этого числа записей индекс не строится, используется точный перебор
+MIN_INDEXED_ROWS = 1000
+# Размер блока строк при пакетном вычислении сходства
+CHUNK_ROWS = 8192
+
+# IVF-индекс: матрица разбита на кластеры (списки), запрос сравнивается только
+# с записями из nprobe ближайших к нему кластеров
+class IVFIndex:
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+
+    @property
+    def nlist(self):
+        return self.centroids.shape[0]
+
+    # Построение индекса сферическим k-means по нормализованной матрице
+    @classmethod
+    def build(cls, matrix, nlist=None, iterations=KMEANS_ITERATIONS, seed=0):
+        rows = matrix.shape[0]
+        nlist = nlist or max(1, int(np.sqrt(rows)))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(matrix[np.sort(rng.choice(rows, size=nlist, replace=False))], dtype=np.float32)
+        assignments = np.zeros(rows, dtype=np.int64)
+        for _ in range(iterations):
+            assignments = _assign(matrix, centroids)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, np.asarray(matrix, dtype=np.float32))
+            norms = np.linalg.norm(sums, axis=1)
+            empty = norms == 0
+            # Пустые кластеры переинициализируем случайными записями
+            if empty.any():
+                sums[empty] = matrix[rng.choice(rows, size=int(empty.sum()), replace=False)]
+                norms[empty] = np.linalg.norm(sums[empty], axis=1)
+            centroids = (sums / norms[:, None]).astype(np.float32)
+        assignments = _assign(matrix, centroids)
+        order = np.argsort(assignments, kind='stable').astype(np.int64)
+        offsets = np.searchsorted(assignments[order], np.arange(nlist + 1)).astype(np.int64)
+        return cls(centroids, order, offsets)
+
+    def save(self, path):
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, order=self.order, offsets=self.offsets)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['centroids'], data['order'], data['offsets'])
+
+    # Позиции строк матрицы из nprobe ближайших к запросу кластеров
+    def candidates(self, query_embedding, nprobe):
+        if nprobe >= self.nlist:
+            return self.order
+        scores = self.centroids @ query_embedding
+        probe = np.argpartition(-scores, nprobe - 1)[:nprobe]
+        return np.concatenate([self.order[self.offsets[c]:self.offsets[c + 1]] for c in probe])
+
+def _assign(matrix, centroids):
+    assignments = np.empty(matrix.shape[0], dtype=np.int64)
+    for start in range(0, matrix.shape[0], CHUNK_ROWS):
+        block = np.asarray(matrix[start:start + CHUNK_ROWS], dtype=np.float32)
+        assignments[start:start + CHUNK_ROWS] = np.argmax(block @ centroids.T, axis=1)
+    return assignments
+
+def _index_path(key):
+    return os.path.join(EMBEDDINGS_DIR, f'{key}.ivf.npz')
+
+# Функция для получения IVF-индекса поколения (построение и сохранение при отсутствии)
+def get_ann_index(key, matrix):
+    if matrix.shape[0] < MIN_INDEXED_ROWS:
+        return None
+    path = _index_path(key)
+    if os.path.exists(path):
+        try:
+            return IVFIndex.load(path)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки IVF-индекса {path}, индекс будет перестроен: {str(e)}")
+    start = time.perf_counter()
+    index = IVFIndex.build(matrix)
+    index.save(path)
+    logger.info(f"IVF-индекс {key[:12]} построен за {time.perf_counter() - start:.2f} с: {index.nlist} списков")
+    return index
+
+# Функция поиска: top_k материалов со сходством выше порога.
+# index=None или exact=True — точный перебор всей матрицы (эталонное поведение)
+def search(ids, matrix, query_embedding, threshold, top_k=None, index=None, nprobe=8, exact=False):
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    if index is None or exact:
+        positions = np.arange(matrix.shape[0])
+        similarities = np.asarray(matrix @ query_embedding) if matrix.shape[0] else np.zeros(0, dtype=np.float32)
+    else:
+        positions = np.sort(index.candidates(query_embedding, nprobe))
+        similarities = np.asarray(matrix[positions] @ query_embedding)
+    mask = similarities > threshold
+    positions, similarities = positions[mask], similarities[mask]
+    ranked = np.argsort(-similarities, kind='stable')
+    if top_k:
+        ranked = ranked[:top_k]
+    return [(int(ids[positions[i]]), float(similarities[i])) for i in ranked]
+
+# Функция для оценки полноты ANN-поиска относительно точного перебора
+def measure_recall(ids, matrix, query_embeddings, threshold, index, nprobe, top_k=None):
+    found = expected = 0
+    exact_time = ann_time = 0.0
+    for query_embedding in query_embeddings:
+        start = time.perf_counter()
+        exact_ids = {i for i, _ in search(ids, matrix, query_embedding, threshold, top_k, exact=True)}
+        exact_time += time.perf_counter() - start
+        start = time.perf_counter()
+        ann_ids = {i for i, _ in search(ids, matrix, query_embedding, threshold, top_k, index=index, nprobe=nprobe)}
+        ann_time += time.perf_counter() - start
+        found += len(exact_ids & ann_ids)
+        expected += len(exact_ids)
+    count = max(1, len(query_embeddings))
+    return {'recall': found / expected if expected else 1.0,
+            'exact_ms': exact_time * 1000 / count, 'ann_ms': ann_time * 1000 / count}
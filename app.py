@@ -3,44 +3,125 @@
 
 from flask import Flask, request, render_template, redirect
 import sqlite3
-from sentence_transformers import SentenceTransformer, util
-import numpy as np
+import json
+import time
+from threading import Lock
+from embeddings import get_embedding_matrix
+from quantization import get_quantized_matrix
+from index_builder import read_generation
+from ann_index import get_ann_index, search
+from batch_encoder import BatchingEncoder
+from model_service import load_model
+from verdict_cache import VerdictCache
+from memory_index import tokenize
+from vocabulary_filter import load_vocabulary_filter
+from hybrid_search import hybrid_search, HYBRID_ALPHA, HYBRID_CANDIDATES
 
 app = Flask(__name__)
 
-# Загружаем модель для векторного поиска
-model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+DB_PATH = './restricted.db'
+# Порог сходства для векторного поиска
+SIMILARITY_THRESHOLD = 0.7
+# Формат матрицы эмбеддингов в памяти: 'float32', 'float16' (вдвое меньше) или 'int8' (вчетверо меньше)
+EMBEDDING_DTYPE = 'float32'
+# Число просматриваемых кластеров IVF-индекса (больше — выше полнота, медленнее поиск)
+ANN_NPROBE = 8
+# Максимальное число возвращаемых совпадений (None — все выше порога)
+ANN_TOP_K = 50
+# Точный перебор всей матрицы вместо ANN-индекса (для сверки результатов)
+ANN_EXACT = False
+# Окно ожидания (мс) и максимальный размер микропакета при кодировании запросов
+ENCODE_MAX_WAIT_MS = 5
+ENCODE_MAX_BATCH = 32
+# Запрос, ни одно слово которого не встречается в корпусе (по фильтру словаря), считается
+# безопасным без кодирования и поиска. Синонимы без общих слов с материалами при этом не ищутся
+VOCAB_FILTER_SHORTCUT = True
+# Режим проверки: 'vector' — поиск по всей матрице через ANN-индекс, 'hybrid' — сходство
+# считается только с кандидатами из FTS5 (при их отсутствии — векторный поиск)
+SEARCH_MODE = 'vector'
 
-# Функция для получения данных из базы
-def get_restricted_materials():
-    conn = sqlite3.connect('./restricted.db')
+# Загружаем модель для векторного поиска (или подключаемся к службе модели, если задан BERKUT_MODEL_SERVICE)
+model = load_model('paraphrase-multilingual-MiniLM-L12-v2')
+# Параллельные запросы кодируются общими пакетами
+encoder = BatchingEncoder(model, max_batch_size=ENCODE_MAX_BATCH, max_wait_ms=ENCODE_MAX_WAIT_MS)
+
+# Матрица эмбеддингов текущего поколения базы
+embedding_state = {'generation': None, 'key': None, 'ids': None, 'matrix': None, 'index': None, 'filter': None}
+embedding_lock = Lock()
+# Результаты проверки повторяющихся запросов в пределах поколения базы
+verdict_cache = VerdictCache()
+
+# Функция для получения матрицы эмбеддингов (перезагрузка только при смене поколения базы)
+def get_embedding_state():
+    conn = sqlite3.connect(DB_PATH)
+    generation = read_generation(conn)
+    with embedding_lock:
+        if embedding_state['generation'] != generation:
+            embedding_state.update(get_embedding_matrix(model, DB_PATH))
+            embedding_state['index'] = get_ann_index(embedding_state['key'], embedding_state['matrix'])
+            embedding_state['matrix'] = get_quantized_matrix(embedding_state['key'], embedding_state['matrix'], EMBEDDING_DTYPE)
+            embedding_state['filter'] = load_vocabulary_filter(conn)
+            embedding_state['generation'] = generation
+        state = (embedding_state['generation'], embedding_state['ids'], embedding_state['matrix'],
+                 embedding_state['index'], embedding_state['filter'])
+    conn.close()
+    return state
+
+# Функция для получения данных из базы по списку id
+def get_restricted_materials(material_ids):
+    if not material_ids:
+        return []
+    conn = sqlite3.connect(DB_PATH)
     cursor = conn.cursor()
-    cursor.execute('SELECT id, date, material FROM restricted_materials')
+    placeholders = ','.join('?' * len(material_ids))
+    cursor.execute(f'SELECT id, date, material FROM restricted_materials WHERE id IN ({placeholders}) ORDER BY id', material_ids)
     materials = cursor.fetchall()
     conn.close()
     return materials
 
+# Проверка запроса в выбранном режиме: список id совпадений и время этапов
+def check_query(query, ids, matrix, ann, mode=SEARCH_MODE, alpha=HYBRID_ALPHA):
+    if mode == 'hybrid':
+        conn = sqlite3.connect(DB_PATH)
+        try:
+            return hybrid_search(conn, encoder.encode, query, ids, matrix, SIMILARITY_THRESHOLD, top_k=ANN_TOP_K,
+                                 index=ann, nprobe=ANN_NPROBE, alpha=alpha, limit=HYBRID_CANDIDATES)
+        finally:
+            conn.close()
+    start = time.perf_counter()
+    # Преобразуем запрос в вектор
+    query_embedding = encoder.encode(query)
+    encoded = time.perf_counter()
+    # Сходство с материалами из ближайших кластеров IVF-индекса
+    hits = search(ids, matrix, query_embedding, SIMILARITY_THRESHOLD, top_k=ANN_TOP_K,
+                  index=ann, nprobe=ANN_NPROBE, exact=ANN_EXACT)
+    finished = time.perf_counter()
+    timings = {'encode_ms': round((encoded - start) * 1000, 3), 'score_ms': round((finished - encoded) * 1000, 3),
+               'total_ms': round((finished - start) * 1000, 3), 'stage': 'vector'}
+    return [{'id': material_id, 'similarity': similarity, 'score': similarity} for material_id, similarity in hits], timings
+
 # Главная страница
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         query = request.form['query']
         
-        # Получаем материалы из базы
-        materials = get_restricted_materials()
-        
-        # Преобразуем запрос в вектор
-        query_embedding = model.encode(query, convert_to_tensor=True)
+        # Получаем предвычисленную матрицу эмбеддингов
+        generation, ids, matrix, ann, vocabulary_filter = get_embedding_state()
         
-        # Проверяем сходство с каждым материалом
-        matches = []
-        for material_id, date, material_text in materials:
-            material_embedding = model.encode(material_text, convert_to_tensor=True)
-            similarity = util.cos_sim(query_embedding, material_embedding).item()
-            
-            # Если сходство выше порога (0.7), добавляем в список совпадений
-            if similarity > 0.7:
-                matches.append((material_id, date, material_text))
+        # Повторный запрос в пределах поколения берётся из кэша без кодирования и поиска
+        cache_key = (SEARCH_MODE, ' '.join(query.split()))
+        matches = verdict_cache.get(generation, cache_key)
+        tokens = tokenize(query)
+        # В гибридном режиме слова вне словаря ведут к векторному поиску, поэтому фильтр не применяется
+        if matches is None and SEARCH_MODE == 'vector' and VOCAB_FILTER_SHORTCUT and vocabulary_filter is not None and tokens \
+                and not any(vocabulary_filter.might_contain(token) for token in tokens):
+            matches = []
+            verdict_cache.put(generation, cache_key, matches)
+        if matches is None:
+            hits, _ = check_query(query, ids, matrix, ann)
+            matches = get_restricted_materials([hit['id'] for hit in hits])
+            verdict_cache.put(generation, cache_key, matches)
         
         if matches:
             return render_template('index.html', warning=matches, query=query)
@@ -50,5 +131,32 @@ def index():
     
     return render_template('index.html')
 
+# Проверка запроса с оценками совпадений и временем этапов: {"query": ..., "mode": ..., "alpha": ...}
+@app.route('/api/check', methods=['POST'])
+def api_check():
+    data = request.get_json(silent=True) or {}
+    query = data.get('query')
+    mode = data.get('mode', SEARCH_MODE)
+    if not isinstance(query, str) or not query.strip():
+        return json.dumps({'is_valid': False, 'error': 'Не указан запрос'}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+    if mode not in ('vector', 'hybrid'):
+        return json.dumps({'is_valid': False, 'error': f"Неизвестный режим проверки: {mode}"}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+    try:
+        alpha = float(data.get('alpha', HYBRID_ALPHA))
+    except (TypeError, ValueError):
+        alpha = -1.0
+    if not 0.0 <= alpha <= 1.0:
+        return json.dumps({'is_valid': False, 'error': 'Вес alpha должен быть в диапазоне [0, 1]'}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+    generation, ids, matrix, ann, _ = get_embedding_state()
+    hits, timings = check_query(query, ids, matrix, ann, mode=mode, alpha=alpha)
+    result = {'query': query, 'mode': mode, 'alpha': alpha if mode == 'hybrid' else None, 'generation': generation,
+              'restricted': bool(hits), 'matches': hits, 'timings': timings}
+    return json.dumps(result, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+# Счётчики кэша результатов проверки
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    return json.dumps(verdict_cache.info(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
 if __name__ == '__main__':
-    app.run(host='127.0.0.1', port=5000, debug=True)
\ No newline at end of file
+    app.run(host='127.0.0.1', port=5000, debug=True, threaded=True)
@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import queue
+import logging
+from threading import Thread, Lock
+from concurrent.futures import Future
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Планировщик микропакетов перед model.encode: запросы, пришедшие в пределах
+# окна ожидания, кодируются одним вызовом модели (не больше max_batch_size за раз)
+class BatchingEncoder:
+    def __init__(self, model, max_batch_size=32, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.stats = {'batches': 0, 'queries': 0, 'max_batch': 0}
+        self._queue = queue.Queue()
+        self._lock = Lock()
+        self._worker = None
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self._run, name='batch-encoder', daemon=True)
+                self._worker.start()
+
+    # Кодирование одного запроса; блокирует вызывающий поток до готовности пакета
+    def encode(self, text, timeout=None):
+        return self.submit(text).result(timeout)
+
+    def submit(self, text):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = np.asarray(self.model.encode(texts, batch_size=len(texts), normalize_embeddings=True,
+                                                          convert_to_numpy=True, show_progress_bar=False), dtype=np.float32)
+            except Exception as e:
+                logger.error(f"Ошибка пакетного кодирования {len(texts)} запросов: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+            self.stats['batches'] += 1
+            self.stats['queries'] += len(batch)
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
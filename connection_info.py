@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import logging
+import requests
+from threading import Thread, Lock, Event
+
+logger = logging.getLogger(__name__)
+
+# Сервис определения публичного IP и местоположения
+IP_INFO_URL = 'http://ip-api.com/json/'
+# Время жизни сведений о подключении, после которого фоновый поток их обновляет (в секундах)
+IP_INFO_TTL = 300
+# Пауза перед повтором после неудачного запроса (в секундах)
+IP_INFO_RETRY = 30
+REQUEST_TIMEOUT = 5
+
+PENDING_INFO = {'ip': 'Определяется...', 'country': 'Определяется...', 'lat': 0.0, 'lon': 0.0}
+
+# Функция для запроса сведений о подключении у сервиса (ответ в формате ip-api.com)
+def fetch_ip_info(url=IP_INFO_URL, timeout=REQUEST_TIMEOUT, session=None):
+    response = (session or requests).get(url, timeout=timeout)
+    data = response.json()
+    if data.get('status') == 'success':
+        return {'ip': data['query'], 'country': data['country'], 'lat': data.get('lat', 0.0), 'lon': data.get('lon', 0.0)}
+    return {'ip': 'Не удалось определить', 'country': 'Не удалось определить', 'lat': 0.0, 'lon': 0.0}
+
+# Кэш сведений о подключении: обработчики запросов сразу получают последнее известное
+# значение, а фоновый поток обновляет его по истечении TTL (или по запросу refresh)
+class ConnectionInfoCache:
+    def __init__(self, url=IP_INFO_URL, ttl=IP_INFO_TTL, timeout=REQUEST_TIMEOUT, session=None):
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.session = session
+        self._info = None
+        self._updated_at = None
+        self._error = None
+        self._lock = Lock()
+        self._wake = Event()
+        self._refreshed = Event()
+        self._worker = None
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = Thread(target=self._run, name='connection-info', daemon=True)
+                self._worker.start()
+
+    # Последнее известное значение без ожидания сети; поле stale показывает,
+    # что данные устарели или последнее обновление завершилось ошибкой
+    def get(self):
+        self._ensure_worker()
+        with self._lock:
+            info = dict(self._info or PENDING_INFO)
+            updated_at = self._updated_at
+            error = self._error
+        age = time.time() - updated_at if updated_at else None
+        info['updated_at'] = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(updated_at)) if updated_at else None
+        info['age'] = round(age, 1) if age is not None else None
+        info['stale'] = age is None or age > self.ttl or error is not None
+        info['error'] = error
+        return info
+
+    # Принудительное обновление: будит фоновый поток и ждёт результата не дольше timeout
+    def refresh(self, timeout=None):
+        self._ensure_worker()
+        self._refreshed.clear()
+        self._wake.set()
+        self._refreshed.wait(self.timeout + 1 if timeout is None else timeout)
+        return self.get()
+
+    def _update(self):
+        start = time.perf_counter()
+        try:
+            info = fetch_ip_info(self.url, self.timeout, self.session)
+        except Exception as e:
+            logger.error(f"Ошибка получения IP: {str(e)}")
+            with self._lock:
+                self._error = str(e)
+            return False
+        with self._lock:
+            self._info = info
+            self._updated_at = time.time()
+            self._error = None
+        logger.info(f"Сведения о подключении обновлены за {time.perf_counter() - start:.2f} с: {info['ip']} ({info['country']})")
+        return True
+
+    def _run(self):
+        while True:
+            success = self._update()
+            self._refreshed.set()
+            # После ошибки повторяем раньше, но не чаще, чем раз в IP_INFO_RETRY секунд
+            self._wake.wait(self.ttl if success else min(self.ttl, IP_INFO_RETRY))
+            self._wake.clear()
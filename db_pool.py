@@ -0,0 +1,109 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sqlite3
+import logging
+import threading
+from index_builder import DB_PATH, read_generation
+
+logger = logging.getLogger(__name__)
+
+# Объём файла базы, отображаемый в память каждым соединением (в байтах)
+MMAP_SIZE = 256 * 1024 * 1024
+# Число подготовленных выражений, которые хранит каждое соединение
+CACHED_STATEMENTS = 64
+# Сколько свободных соединений пул держит открытыми между запросами
+MAX_IDLE = 8
+
+# Пул соединений только для чтения с mmap и кэшем подготовленных выражений.
+# Поток получает соединение при первом обращении и пользуется им до release();
+# освобождённое соединение остаётся открытым и достаётся следующему потоку.
+# При смене поколения индекса соединение пересоздаётся при следующем обращении
+class ReadConnectionPool:
+    def __init__(self, db_path=DB_PATH, mmap_size=MMAP_SIZE, cached_statements=CACHED_STATEMENTS, max_idle=MAX_IDLE):
+        self.db_path = db_path
+        self.mmap_size = mmap_size
+        self.cached_statements = cached_statements
+        self.max_idle = max_idle
+        self.stats = {'opened': 0, 'reused': 0, 'reconnected': 0}
+        self._local = threading.local()
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not os.path.exists(self.db_path):
+            raise sqlite3.OperationalError(f"База данных {self.db_path} не найдена")
+        uri = 'file:' + os.path.abspath(self.db_path).replace('\\', '/') + '?mode=ro'
+        # Соединение переходит между потоками только через пул и не используется двумя потоками сразу
+        conn = sqlite3.connect(uri, uri=True, timeout=30, cached_statements=self.cached_statements, check_same_thread=False)
+        conn.execute(f'PRAGMA mmap_size={self.mmap_size}')
+        conn.execute('PRAGMA query_only=1')
+        self.stats['opened'] += 1
+        return [conn, conn.execute('PRAGMA data_version').fetchone()[0], read_generation(conn)]
+
+    # Проверка, что соединение видит текущее поколение. PRAGMA data_version меняется
+    # только после записи другим соединением, поэтому поколение перечитывается лишь в этом случае
+    def _validate(self, entry):
+        conn = entry[0]
+        try:
+            data_version = conn.execute('PRAGMA data_version').fetchone()[0]
+            if data_version == entry[1]:
+                return entry
+            entry[1] = data_version
+            generation = read_generation(conn)
+            if generation == entry[2]:
+                return entry
+            logger.info(f"Поколение индекса изменилось ({entry[2]} -> {generation}), соединение чтения пересоздаётся")
+        except sqlite3.Error as e:
+            logger.warning(f"Соединение чтения недействительно, выполняется переподключение: {str(e)}")
+        self._close(conn)
+        self.stats['reconnected'] += 1
+        return self._connect()
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    # Соединение текущего потока (из числа свободных или новое)
+    def connection(self):
+        entry = getattr(self._local, 'entry', None)
+        if entry is None:
+            with self._lock:
+                entry = self._idle.pop() if self._idle else None
+            if entry is None:
+                entry = self._connect()
+            else:
+                self.stats['reused'] += 1
+        entry = self._validate(entry)
+        self._local.entry = entry
+        return entry[0]
+
+    # Номер поколения индекса, которое видит соединение текущего потока
+    def generation(self):
+        self.connection()
+        return self._local.entry[2]
+
+    # Возврат соединения текущего потока в пул (вызывается по окончании запроса)
+    def release(self):
+        entry = getattr(self._local, 'entry', None)
+        if entry is None:
+            return
+        self._local.entry = None
+        if entry[0].in_transaction:
+            entry[0].rollback()
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(entry)
+                return
+        self._close(entry[0])
+
+    # Закрытие всех свободных соединений (например, перед удалением файла базы)
+    def close(self):
+        self.release()
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._close(conn)
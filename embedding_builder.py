@@ -0,0 +1,195 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+import logging
+import argparse
+import tempfile
+import multiprocessing
+import numpy as np
+from embeddings import (get_materials, calculate_generation_key, load_embedding_store, plan_embedding_update,
+                        copy_reused_rows, create_embedding_matrix, finalize_embedding_store, encode_texts, embedding_lock)
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+# Число записей в одной задаче процесса-кодировщика
+BUILD_CHUNK_SIZE = 256
+# Число процессов-кодировщиков по умолчанию
+BUILD_WORKERS = max(1, (os.cpu_count() or 1) // 2)
+# Интервал вывода прогресса (в секундах)
+PROGRESS_INTERVAL = 2.0
+
+# Модель процесса-кодировщика (загружается один раз при запуске процесса)
+_worker_model = None
+
+def _init_worker(model_name, threads):
+    global _worker_model
+    # Ограничиваем потоки torch, чтобы процессы не делили между собой одни и те же ядра
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name)
+
+def _worker_dimension():
+    return _worker_model.get_sentence_embedding_dimension()
+
+# Кодирование части записей с записью векторов прямо в общую матрицу на диске
+def _encode_chunk(task):
+    matrix_path, positions, texts = task
+    matrix = np.load(matrix_path, mmap_mode='r+')
+    matrix[positions] = encode_texts(_worker_model, texts)
+    matrix.flush()
+    del matrix
+    return len(positions)
+
+def _chunks(materials, positions, chunk_size):
+    for start in range(0, len(positions), chunk_size):
+        part = positions[start:start + chunk_size]
+        yield part, [materials[position][2] for position in part]
+
+# Пул процессов-кодировщиков; каждый загружает модель один раз при запуске.
+# spawn — как на Windows и без копирования состояния torch родительского процесса
+def encoder_pool(model_name=MODEL_NAME, workers=BUILD_WORKERS):
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    return multiprocessing.get_context('spawn').Pool(workers, initializer=_init_worker, initargs=(model_name, threads))
+
+# Размерность эмбеддингов от процесса пула: модель уже загружена им для кодирования
+def pool_dimension(pool):
+    return pool.apply(_worker_dimension)
+
+# Кодирование строк positions в матрицу matrix_path пулом процессов pool.
+# progress(done, total) вызывается по мере завершения задач
+def encode_parallel(pool, materials, positions, matrix_path, chunk_size=BUILD_CHUNK_SIZE, progress=None):
+    tasks = ((matrix_path, part, texts) for part, texts in _chunks(materials, positions, chunk_size))
+    done = 0
+    for count in pool.imap_unordered(_encode_chunk, tasks):
+        done += count
+        if progress:
+            progress(done, len(positions))
+
+def _remove_tmp(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Не удалось удалить временную матрицу эмбеддингов {path}: {str(e)}")
+
+# Вывод прогресса в журнал не чаще PROGRESS_INTERVAL: число записей, скорость и оставшееся время
+class ProgressReporter:
+    def __init__(self, label, interval=PROGRESS_INTERVAL):
+        self.label = label
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.reported = 0.0
+
+    def __call__(self, done, total):
+        now = time.perf_counter()
+        if done < total and now - self.reported < self.interval:
+            return
+        self.reported = now
+        elapsed = now - self.started
+        rate = done / elapsed if elapsed > 0 else 0.0
+        eta = (total - done) / rate if rate > 0 else 0.0
+        logger.info(f"{self.label}: {done} из {total} ({done * 100 / max(1, total):.1f}%), "
+                    f"{rate:.1f} записей/с, осталось ~{eta:.0f} с")
+
+# Построение хранилища эмбеддингов текущего поколения базы пулом процессов.
+# Векторы неизменившихся записей переносятся из прошлого поколения, как в get_embedding_matrix.
+# progress(done, total) вызывается вместе с выводом в журнал; исключение из него прерывает построение.
+# Одновременная сборка того же ключа другим процессом (например, app.py) дожидается её завершения
+def build_embedding_store(db_path, model_name=MODEL_NAME, workers=BUILD_WORKERS, chunk_size=BUILD_CHUNK_SIZE, progress=None):
+    materials = get_materials(db_path)
+    key = calculate_generation_key(materials)
+    with embedding_lock(key):
+        if load_embedding_store(key) is not None:
+            logger.info(f"Хранилище эмбеддингов {key[:12]} уже построено: {len(materials)} записей")
+            return {'key': key, 'rows': len(materials), 'encoded': 0, 'reused': 0, 'seconds': 0.0}
+        return _build_store(materials, key, model_name, workers, chunk_size, progress)
+
+def _build_store(materials, key, model_name, workers, chunk_size, progress):
+    start = time.perf_counter()
+    ids, hashes, previous, reused, missing = plan_embedding_update(materials, key)
+    dimension = previous['matrix'].shape[1] if previous is not None else 0
+    pool = encoder_pool(model_name, workers) if missing else None
+    matrix_path = None
+    try:
+        if previous is None and pool is not None:
+            dimension = pool_dimension(pool)
+        matrix_path, matrix = create_embedding_matrix(key, len(materials), dimension)
+        copy_reused_rows(matrix, previous, reused)
+        matrix.flush()
+        # Родительский процесс отпускает матрицу до записи в неё процессами-кодировщиками
+        del matrix, previous
+        logger.info(f"Построение эмбеддингов {key[:12]}: кодируется {len(missing)} записей, переиспользовано {len(reused)}, "
+                    f"процессов {workers}, размер задачи {chunk_size}")
+        if missing:
+            reporter = ProgressReporter('Эмбеддинги')
+
+            def report(done, total):
+                reporter(done, total)
+                if progress:
+                    progress(done, total)
+
+            encode_parallel(pool, materials, missing, matrix_path, chunk_size, report)
+        finalize_embedding_store(key, ids, hashes)
+    except BaseException:
+        # Ошибка или отмена (исключение из progress): временная матрица этого процесса не нужна
+        if matrix_path is not None:
+            _remove_tmp(matrix_path)
+        raise
+    finally:
+        if pool is not None:
+            pool.terminate()
+    seconds = time.perf_counter() - start
+    logger.info(f"Хранилище эмбеддингов {key[:12]} построено за {seconds:.2f} с")
+    return {'key': key, 'rows': len(materials), 'encoded': len(missing), 'reused': len(reused), 'seconds': seconds}
+
+# Замер скорости кодирования для разного числа процессов (матрица пишется во временный файл)
+def benchmark(db_path, worker_counts, limit, model_name=MODEL_NAME, chunk_size=BUILD_CHUNK_SIZE):
+    materials = get_materials(db_path)[:limit]
+    positions = list(range(len(materials)))
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        matrix_path = os.path.join(directory, 'bench.npy')
+        for workers in worker_counts:
+            start = time.perf_counter()
+            with encoder_pool(model_name, workers) as pool:
+                if not os.path.exists(matrix_path):
+                    np.lib.format.open_memmap(matrix_path, mode='w+', dtype=np.float32,
+                                              shape=(len(materials), pool_dimension(pool))).flush()
+                encode_parallel(pool, materials, positions, matrix_path, chunk_size)
+            seconds = time.perf_counter() - start
+            results.append((workers, seconds))
+            print(f"процессов {workers:>2}: {seconds:7.2f} с, {len(materials) / seconds:8.1f} записей/с, "
+                  f"ускорение {results[0][1] / seconds:.2f}x")
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Построение эмбеддингов реестра пулом процессов')
+    parser.add_argument('command', choices=['build', 'bench'])
+    parser.add_argument('--db', default='./restricted.db')
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--workers', default=str(BUILD_WORKERS),
+                        help='число процессов; для bench — список через запятую, например 1,2,4')
+    parser.add_argument('--chunk-size', type=int, default=BUILD_CHUNK_SIZE)
+    parser.add_argument('--limit', type=int, default=2000, help='число записей для bench')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    worker_counts = [int(value) for value in args.workers.split(',') if value.strip()]
+    if not worker_counts or min(worker_counts) < 1 or args.chunk_size < 1:
+        parser.error('число процессов и размер задачи должны быть положительными')
+    if args.command == 'build':
+        build_embedding_store(args.db, args.model, worker_counts[0], args.chunk_size)
+    else:
+        benchmark(args.db, worker_counts, args.limit, args.model, args.chunk_size)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,193 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sqlite3
+import time
+import hashlib
+import logging
+import numpy as np
+from file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# Каталог хранилища эмбеддингов (матрица, id и хэши текстов материалов)
+EMBEDDINGS_DIR = './embeddings'
+# Размер пакета при кодировании материалов
+ENCODE_BATCH_SIZE = 64
+
+# Функция для получения материалов из базы в порядке id
+def get_materials(db_path):
+    conn = sqlite3.connect(db_path)
+    cursor = conn.cursor()
+    cursor.execute('SELECT id, date, material FROM restricted_materials ORDER BY id')
+    materials = cursor.fetchall()
+    conn.close()
+    return materials
+
+# Функция для вычисления ключа поколения по содержимому базы
+def calculate_generation_key(materials):
+    sha256 = hashlib.sha256()
+    for material_id, _, material_text in materials:
+        sha256.update(f"{material_id}\x00{material_text}\x00".encode('utf-8'))
+    return sha256.hexdigest()
+
+# Функция для кодирования текстов в нормализованные векторы float32
+def encode_texts(model, texts):
+    embeddings = model.encode(list(texts), batch_size=ENCODE_BATCH_SIZE, normalize_embeddings=True,
+                              convert_to_numpy=True, show_progress_bar=False)
+    return np.asarray(embeddings, dtype=np.float32)
+
+# Функция для вычисления хэша текста материала (ключ записи в хранилище вместе с id)
+def calculate_text_hash(material_text):
+    return hashlib.blake2b(material_text.encode('utf-8'), digest_size=16).hexdigest()
+
+def _store_paths(key):
+    return {
+        'matrix': os.path.join(EMBEDDINGS_DIR, f'{key}.npy'),
+        'ids': os.path.join(EMBEDDINGS_DIR, f'{key}.ids.npy'),
+        'hashes': os.path.join(EMBEDDINGS_DIR, f'{key}.hashes.npy'),
+    }
+
+# Временный файл своего процесса: app.py и задача пересборки в run.py могут строить хранилище одновременно
+def _tmp_path(path):
+    return f'{path}.{os.getpid()}.tmp'
+
+# Блокировка построения хранилища ключа key (между процессами и потоками)
+def embedding_lock(key):
+    return FileLock(os.path.join(EMBEDDINGS_DIR, f'{key}.lock'))
+
+# Функция для сохранения хранилища на диск (запись во временный файл и атомарная замена)
+def save_embedding_store(key, ids, hashes, matrix):
+    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+    tmp_path = _tmp_path(_store_paths(key)['matrix'])
+    with open(tmp_path, 'wb') as f:
+        np.save(f, matrix)
+    finalize_embedding_store(key, ids, hashes)
+
+# Функция для создания временной матрицы поколения, отображённой в память; строки заполняются
+# на месте (в том числе другими процессами), затем хранилище фиксируется finalize_embedding_store
+def create_embedding_matrix(key, rows, dimension):
+    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+    tmp_path = _tmp_path(_store_paths(key)['matrix'])
+    return tmp_path, np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(rows, dimension))
+
+# Функция для удаления файлов других поколений. Ключ, хранилище которого сейчас строится
+# (его блокировка занята), не трогается; у свободных удаляются и готовые файлы, и остатки прерванной сборки
+def _remove_stale_stores(key):
+    groups = {}
+    for name in os.listdir(EMBEDDINGS_DIR):
+        groups.setdefault(name.split('.', 1)[0], []).append(name)
+    groups.pop(key, None)
+    for other, names in groups.items():
+        lock = embedding_lock(other)
+        if not lock.acquire(blocking=False):
+            continue
+        try:
+            for name in names:
+                if name.endswith('.lock'):
+                    continue
+                try:
+                    os.remove(os.path.join(EMBEDDINGS_DIR, name))
+                except OSError as e:
+                    logger.warning(f"Не удалось удалить устаревший файл эмбеддингов {name}: {str(e)}")
+        finally:
+            lock.release()
+        try:
+            os.remove(os.path.join(EMBEDDINGS_DIR, f'{other}.lock'))
+        except OSError:
+            pass
+
+# Функция для фиксации хранилища: запись id и хэшей, атомарная замена временной матрицы.
+# Вызывается под блокировкой embedding_lock(key)
+def finalize_embedding_store(key, ids, hashes):
+    paths = _store_paths(key)
+    arrays = {'ids': np.asarray(ids, dtype=np.int64), 'hashes': np.asarray(hashes, dtype='U32')}
+    for name in ('ids', 'hashes'):
+        tmp_path = _tmp_path(paths[name])
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arrays[name])
+        os.replace(tmp_path, paths[name])
+    # Матрица заменяется последней: хранилище без неё не считается сохранённым
+    os.replace(_tmp_path(paths['matrix']), paths['matrix'])
+    # Удаляем хранилища предыдущих поколений
+    _remove_stale_stores(key)
+
+# Функция для загрузки хранилища с диска (матрица отображается в память), None если его нет
+def load_embedding_store(key):
+    paths = _store_paths(key)
+    if not all(os.path.exists(path) for path in paths.values()):
+        return None
+    try:
+        return {'key': key, 'ids': np.load(paths['ids']), 'hashes': np.load(paths['hashes']),
+                'matrix': np.load(paths['matrix'], mmap_mode='r')}
+    except Exception as e:
+        logger.error(f"Ошибка загрузки хранилища эмбеддингов {key[:12]}: {str(e)}")
+        return None
+
+# Функция для поиска последнего сохранённого хранилища (основа для инкрементального обновления)
+def _load_previous_store(key):
+    if not os.path.isdir(EMBEDDINGS_DIR):
+        return None
+    for name in os.listdir(EMBEDDINGS_DIR):
+        if name.endswith('.hashes.npy') and not name.startswith(key):
+            store = load_embedding_store(name[:-len('.hashes.npy')])
+            if store is not None:
+                return store
+    return None
+
+# Функция для сопоставления материалов с прошлым поколением хранилища: id и хэши строк,
+# прошлое хранилище, пары (строка, строка прошлого поколения) для переиспользования
+# и строки, которые нужно закодировать заново
+def plan_embedding_update(materials, key):
+    ids = np.array([material_id for material_id, _, _ in materials], dtype=np.int64)
+    hashes = np.array([calculate_text_hash(material_text) for _, _, material_text in materials], dtype='U32')
+    previous = _load_previous_store(key)
+    known = {}
+    if previous is not None:
+        known = {(int(material_id), str(text_hash)): row
+                 for row, (material_id, text_hash) in enumerate(zip(previous['ids'], previous['hashes']))}
+    reused_rows = [known.get((int(material_id), str(text_hash)), -1) for material_id, text_hash in zip(ids, hashes)]
+    reused = [(position, row) for position, row in enumerate(reused_rows) if row >= 0]
+    missing = [position for position, row in enumerate(reused_rows) if row < 0]
+    return ids, hashes, previous, reused, missing
+
+# Функция для копирования переиспользуемых векторов прошлого поколения в новую матрицу
+def copy_reused_rows(matrix, previous, reused):
+    if reused:
+        positions, rows = map(np.array, zip(*reused))
+        matrix[positions] = previous['matrix'][rows]
+
+# Функция для получения эмбеддингов текущего поколения базы. Кодируются только новые
+# и изменённые записи (по id и хэшу текста), векторы остальных берутся из прошлого поколения
+def get_embedding_matrix(model, db_path):
+    materials = get_materials(db_path)
+    key = calculate_generation_key(materials)
+    store = load_embedding_store(key)
+    if store is not None:
+        logger.info(f"Загружена матрица эмбеддингов {key[:12]}: {store['matrix'].shape[0]} записей")
+        return store
+    with embedding_lock(key):
+        # Пока ждали блокировку, хранилище мог построить другой процесс
+        store = load_embedding_store(key)
+        if store is not None:
+            logger.info(f"Загружена матрица эмбеддингов {key[:12]}, построенная другим процессом")
+            return store
+        return _build_embedding_matrix(model, materials, key)
+
+def _build_embedding_matrix(model, materials, key):
+    start = time.perf_counter()
+    ids, hashes, previous, reused, missing = plan_embedding_update(materials, key)
+    dimension = previous['matrix'].shape[1] if previous is not None else None
+    encoded = encode_texts(model, (materials[position][2] for position in missing)) if missing else None
+    if dimension is None:
+        dimension = encoded.shape[1] if encoded is not None else 0
+    matrix = np.empty((len(materials), dimension), dtype=np.float32)
+    copy_reused_rows(matrix, previous, reused)
+    if missing:
+        matrix[missing] = encoded
+    removed = len(set(previous['ids'].tolist()) - set(ids.tolist())) if previous is not None else 0
+    save_embedding_store(key, ids, hashes, matrix)
+    logger.info(f"Матрица эмбеддингов {key[:12]} обновлена за {time.perf_counter() - start:.2f} с: "
+                f"закодировано {len(missing)}, переиспользовано {len(reused)}, удалено {removed}")
+    return load_embedding_store(key)
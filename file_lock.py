@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+# Интервал повторных попыток блокировки на Windows (в секундах)
+RETRY_INTERVAL = 0.1
+
+# Межпроцессная блокировка на файле (fcntl.flock, на Windows — msvcrt.locking). Каждый объект открывает
+# файл заново, поэтому блокировка действует и между потоками одного процесса. Система снимает её
+# при закрытии файла, в том числе при аварийном завершении процесса, и устаревших блокировок не остаётся
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    # Занятие блокировки: False, если blocking=False и блокировку держит другой процесс или поток
+    def acquire(self, blocking=True):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        f = open(self.path, 'a+b')
+        try:
+            if sys.platform == 'win32':
+                f.seek(0)
+                while True:
+                    try:
+                        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+                        break
+                    except OSError:
+                        if not blocking:
+                            f.close()
+                            return False
+                        time.sleep(RETRY_INTERVAL)
+            else:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+                except BlockingIOError:
+                    f.close()
+                    return False
+        except Exception:
+            f.close()
+            raise
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        try:
+            if sys.platform == 'win32':
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        finally:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.release()
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import time
+import logging
+import numpy as np
+from memory_index import tokenize
+from ann_index import search
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число кандидатов лексического этапа (лучшие по bm25)
+HYBRID_CANDIDATES = 200
+# Вес семантического сходства в итоговой оценке (остальное — нормированный bm25)
+HYBRID_ALPHA = 0.8
+# Поиск по началу слова для слов не короче HYBRID_PREFIX_MIN символов (0 — без префиксов)
+HYBRID_PREFIX_MIN = 4
+
+# FTS5-запрос «любое из слов»: каждое слово в кавычках, длинные — с поиском по началу слова
+def build_or_query(tokens, prefix_min=HYBRID_PREFIX_MIN):
+    terms = []
+    for token in dict.fromkeys(tokens):
+        terms.append(f'"{token}"*' if prefix_min and len(token) >= prefix_min else f'"{token}"')
+    return ' OR '.join(terms)
+
+# Лексический этап: id кандидатов и их bm25, нормированный к [0, 1] относительно лучшего
+def lexical_candidates(conn, tokens, limit=HYBRID_CANDIDATES, prefix_min=HYBRID_PREFIX_MIN):
+    if not tokens:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    rows = conn.execute('SELECT rowid, bm25(restricted_materials_fts) FROM restricted_materials_fts '
+                        'WHERE material MATCH ? ORDER BY rank LIMIT ?', (build_or_query(tokens, prefix_min), limit)).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+    candidate_ids = np.array([row[0] for row in rows], dtype=np.int64)
+    # bm25() в FTS5 отрицателен: чем меньше, тем релевантнее
+    relevance = -np.array([row[1] for row in rows], dtype=np.float32)
+    best = relevance.max()
+    return candidate_ids, relevance / best if best > 0 else np.ones_like(relevance)
+
+# Гибридная проверка: кандидаты из FTS5 (OR по словам запроса), семантическое сходство
+# только с ними и итоговая оценка alpha * сходство + (1 - alpha) * bm25. Если лексических
+# кандидатов нет, выполняется обычный векторный поиск по ANN-индексу (оценка = сходство).
+# Возвращает совпадения выше порога и время этапов в миллисекундах
+def hybrid_search(conn, encode, query, ids, matrix, threshold, top_k=None, index=None, nprobe=8,
+                  alpha=HYBRID_ALPHA, limit=HYBRID_CANDIDATES, prefix_min=HYBRID_PREFIX_MIN):
+    timings = {}
+    start = time.perf_counter()
+    candidate_ids, lexical = lexical_candidates(conn, tokenize(query), limit, prefix_min)
+    timings['lexical_ms'] = (time.perf_counter() - start) * 1000
+    stage_start = time.perf_counter()
+    query_embedding = np.asarray(encode(query), dtype=np.float32)
+    timings['encode_ms'] = (time.perf_counter() - stage_start) * 1000
+    stage_start = time.perf_counter()
+    if len(candidate_ids):
+        positions = np.searchsorted(ids, candidate_ids)
+        known = (positions < len(ids)) & (ids[np.minimum(positions, len(ids) - 1)] == candidate_ids) if len(ids) else np.zeros(len(candidate_ids), dtype=bool)
+        candidate_ids, lexical, positions = candidate_ids[known], lexical[known], positions[known]
+        similarities = np.asarray(matrix[positions] @ query_embedding) if len(positions) else np.zeros(0, dtype=np.float32)
+        scores = alpha * similarities + (1 - alpha) * lexical
+        ranked = [i for i in np.argsort(-scores, kind='stable') if scores[i] > threshold]
+        if top_k:
+            ranked = ranked[:top_k]
+        hits = [{'id': int(candidate_ids[i]), 'similarity': float(similarities[i]), 'lexical': float(lexical[i]),
+                 'score': float(scores[i])} for i in ranked]
+        stage = 'hybrid'
+    else:
+        hits = [{'id': material_id, 'similarity': similarity, 'lexical': 0.0, 'score': similarity}
+                for material_id, similarity in search(ids, matrix, query_embedding, threshold, top_k, index=index, nprobe=nprobe)]
+        stage = 'vector_fallback'
+    timings['score_ms'] = (time.perf_counter() - stage_start) * 1000
+    timings['total_ms'] = (time.perf_counter() - start) * 1000
+    timings = {name: round(value, 3) for name, value in timings.items()}
+    logger.info(f"Гибридная проверка ({stage}): кандидатов {len(candidate_ids)}, совпадений {len(hits)}, {timings['total_ms']:.1f} мс")
+    return hits, dict(timings, stage=stage, candidates=int(len(candidate_ids)))
@@ -0,0 +1,263 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import sqlite3
+import hashlib
+import logging
+from vocabulary_filter import rebuild_vocabulary_filter
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = './restricted.db'
+# Версия схемы индекса (rowid FTS = id материала, таблицы index_meta и vocabulary_filter)
+SCHEMA_VERSION = 2
+# Теневая база, в которую строится новое поколение индекса
+SHADOW_SUFFIX = '.building'
+# Копия предыдущего поколения для мгновенного отката
+PREVIOUS_SUFFIX = '.prev'
+# Временная база, в которой готовится откат
+ROLLBACK_SUFFIX = '.rollback'
+# Размер кэша страниц SQLite на время загрузки (в КиБ, отрицательное значение)
+BULK_CACHE_SIZE = -65536
+
+# Массовая загрузка материалов в restricted_materials и restricted_materials_fts
+# одной транзакцией с облегчённым журналированием и слиянием индекса FTS5 в конце
+def bulk_load_materials(conn, materials):
+    start = time.perf_counter()
+    conn.commit()
+    cursor = conn.cursor()
+    journal_mode = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+    synchronous = cursor.execute('PRAGMA synchronous').fetchone()[0]
+    cache_size = cursor.execute('PRAGMA cache_size').fetchone()[0]
+    cursor.execute('PRAGMA journal_mode=MEMORY')
+    cursor.execute('PRAGMA synchronous=OFF')
+    cursor.execute(f'PRAGMA cache_size={BULK_CACHE_SIZE}')
+    try:
+        cursor.execute('BEGIN')
+        cursor.execute('DROP TABLE IF EXISTS restricted_materials_fts')
+        cursor.execute('CREATE VIRTUAL TABLE restricted_materials_fts USING fts5(id, date, material)')
+        cursor.execute('CREATE TABLE IF NOT EXISTS restricted_materials (id INTEGER PRIMARY KEY, date TEXT, material TEXT)')
+        cursor.execute('DELETE FROM restricted_materials')
+        cursor.executemany('INSERT INTO restricted_materials (id, date, material) VALUES (?, ?, ?)', materials)
+        count = cursor.execute('SELECT COUNT(*) FROM restricted_materials').fetchone()[0]
+        # rowid записи FTS совпадает с id материала
+        cursor.execute('INSERT INTO restricted_materials_fts (rowid, id, date, material) '
+                       'SELECT id, id, date, material FROM restricted_materials')
+        cursor.execute("INSERT INTO restricted_materials_fts (restricted_materials_fts) VALUES ('optimize')")
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.execute(f'PRAGMA journal_mode={journal_mode}')
+        cursor.execute(f'PRAGMA synchronous={synchronous}')
+        cursor.execute(f'PRAGMA cache_size={cache_size}')
+    logger.info(f"Индекс перестроен за {time.perf_counter() - start:.2f} с, загружено {count} записей")
+    return count
+
+# Функция для вычисления хэша записи (дата и текст материала)
+def calculate_record_hash(date, material_text):
+    return hashlib.blake2b(f"{date}\x00{material_text}".encode('utf-8'), digest_size=16).digest()
+
+# Проверка, что база уже в формате с rowid FTS, равным id материала (иначе точечные правки невозможны)
+def _supports_diff(cursor):
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'restricted_materials_fts'")
+    if cursor.fetchone()[0] == 0:
+        return False
+    cursor.execute('SELECT COUNT(*) FROM restricted_materials_fts WHERE rowid != CAST(id AS INTEGER)')
+    return cursor.fetchone()[0] == 0
+
+# Хэш источника может быть известен только после чтения всех записей (потоковый разбор),
+# поэтому вместо строки допускается функция без аргументов
+def _resolve_hash(source_hash):
+    return source_hash() if callable(source_hash) else source_hash
+
+# Применение к базе только разницы между разобранными и сохранёнными записями:
+# INSERT новых, UPDATE изменённых и DELETE исчезнувших в обеих таблицах одной транзакцией
+def apply_material_diff(conn, materials, source_hash=None):
+    start = time.perf_counter()
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'restricted_materials'")
+    stored = {}
+    if cursor.fetchone()[0]:
+        stored = {material_id: calculate_record_hash(date, material_text)
+                  for material_id, date, material_text in cursor.execute('SELECT id, date, material FROM restricted_materials')}
+    full_load = not _supports_diff(cursor)
+    if full_load:
+        materials = list(materials)
+    added, changed, seen = [], [], set()
+    for material_id, date, material_text in materials:
+        seen.add(material_id)
+        old_hash = stored.get(material_id)
+        if old_hash is None:
+            added.append((material_id, date, material_text))
+        elif old_hash != calculate_record_hash(date, material_text):
+            changed.append((material_id, date, material_text))
+    removed = [(material_id,) for material_id in stored.keys() - seen]
+    db_path = cursor.execute('PRAGMA database_list').fetchone()[2]
+    if full_load:
+        logger.info("Структура базы не поддерживает точечное обновление, выполняется полная загрузка")
+        count = rebuild_database(materials, db_path, source_hash)['count']
+    else:
+        if db_path and (added or changed or removed):
+            # Текущее поколение сохраняется до изменений, чтобы откат возвращал к нему, а не к последней полной пересборке
+            save_previous_generation(db_path)
+        try:
+            cursor.executemany('DELETE FROM restricted_materials WHERE id = ?', removed)
+            cursor.executemany('DELETE FROM restricted_materials_fts WHERE rowid = ?', removed)
+            cursor.executemany('UPDATE restricted_materials SET date = ?, material = ? WHERE id = ?',
+                               [(date, material_text, material_id) for material_id, date, material_text in changed])
+            cursor.executemany('DELETE FROM restricted_materials_fts WHERE rowid = ?', [(material_id,) for material_id, _, _ in changed])
+            cursor.executemany('INSERT INTO restricted_materials (id, date, material) VALUES (?, ?, ?)', added)
+            cursor.executemany('INSERT INTO restricted_materials_fts (rowid, id, date, material) VALUES (?, ?, ?, ?)',
+                               [(material_id, material_id, date, material_text) for material_id, date, material_text in added + changed])
+            if added or changed or removed:
+                _write_generation(cursor, read_generation(conn) + 1)
+                _write_meta(cursor, {'filter_fp_rate': rebuild_vocabulary_filter(cursor)})
+            if source_hash is not None:
+                _write_meta(cursor, {'source_hash': _resolve_hash(source_hash)})
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        count = len(seen)
+    logger.info(f"Обновление базы за {time.perf_counter() - start:.2f} с: добавлено {len(added)}, "
+                f"изменено {len(changed)}, удалено {len(removed)}, всего {count} записей")
+    return {'added': len(added), 'changed': len(changed), 'removed': len(removed), 'count': count}
+
+# Функция для чтения служебных данных индекса (поколение, время сборки)
+def read_meta(conn):
+    try:
+        return dict(conn.execute('SELECT key, value FROM index_meta').fetchall())
+    except sqlite3.OperationalError:
+        return {}
+
+# Функция для чтения номера поколения индекса (0 для баз без служебной таблицы)
+def read_generation(conn):
+    return int(read_meta(conn).get('generation', 0))
+
+def _write_meta(cursor, values):
+    cursor.execute('CREATE TABLE IF NOT EXISTS index_meta (key TEXT PRIMARY KEY, value TEXT)')
+    cursor.executemany('INSERT OR REPLACE INTO index_meta (key, value) VALUES (?, ?)',
+                       [(key, str(value)) for key, value in values.items()])
+
+def _write_generation(cursor, generation):
+    _write_meta(cursor, {'generation': generation, 'built_at': time.strftime('%Y-%m-%d %H:%M:%S')})
+
+def _remove_file(path):
+    for suffix in ('', '-journal', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+# Копия текущего (зафиксированного) поколения рабочей базы в файл .prev для отката
+def save_previous_generation(db_path=DB_PATH):
+    if not os.path.exists(db_path) or os.path.getsize(db_path) == 0:
+        return False
+    _remove_file(db_path + PREVIOUS_SUFFIX)
+    live = sqlite3.connect(db_path, timeout=30)
+    previous = sqlite3.connect(db_path + PREVIOUS_SUFFIX)
+    try:
+        live.backup(previous)
+    finally:
+        previous.close()
+        live.close()
+    return True
+
+# Атомарная подмена содержимого рабочей базы через backup API: читатели в режиме WAL
+# до фиксации видят старое поколение целиком, после — новое. Старое поколение
+# сохраняется в файл .prev для отката (кроме подмены при самом откате)
+def _swap_in(source_conn, db_path, keep_previous=True):
+    if keep_previous:
+        save_previous_generation(db_path)
+    live = sqlite3.connect(db_path, timeout=30)
+    try:
+        live.execute('PRAGMA journal_mode=WAL')
+        source_conn.backup(live)
+    finally:
+        live.close()
+
+# Полная пересборка: новое поколение строится в теневой базе и подменяет рабочую целиком,
+# так что запросы во время пересборки не видят частично заполненный индекс
+def rebuild_database(materials, db_path=DB_PATH, source_hash=''):
+    start = time.perf_counter()
+    generation = 0
+    if os.path.exists(db_path):
+        live = sqlite3.connect(db_path)
+        generation = read_generation(live)
+        live.close()
+    shadow_path = db_path + SHADOW_SUFFIX
+    _remove_file(shadow_path)
+    shadow = sqlite3.connect(shadow_path)
+    try:
+        count = bulk_load_materials(shadow, materials)
+        cursor = shadow.cursor()
+        _write_generation(cursor, generation + 1)
+        _write_meta(cursor, {'schema_version': SCHEMA_VERSION, 'source_hash': _resolve_hash(source_hash),
+                             'filter_fp_rate': rebuild_vocabulary_filter(cursor)})
+        shadow.commit()
+        _swap_in(shadow, db_path)
+    finally:
+        shadow.close()
+        _remove_file(shadow_path)
+    logger.info(f"Поколение индекса {generation + 1} подключено за {time.perf_counter() - start:.2f} с")
+    return {'count': count, 'generation': generation + 1}
+
+# Откат рабочей базы к сохранённому предыдущему поколению. Хэш источника сбрасывается:
+# база больше не соответствует последней версии реестра, и следующее обновление применит её заново
+def rollback_generation(db_path=DB_PATH):
+    previous_path = db_path + PREVIOUS_SUFFIX
+    if not os.path.exists(previous_path):
+        return {'rolled_back': False, 'error': 'Предыдущее поколение индекса не сохранено'}
+    live = sqlite3.connect(db_path, timeout=30)
+    try:
+        current = read_generation(live)
+    finally:
+        live.close()
+    # Номер поколения и хэш меняются во временной копии, и рабочая база подменяется одним шагом:
+    # прерванный откат не оставляет базу со старым содержимым под прежним номером поколения
+    staging_path = db_path + ROLLBACK_SUFFIX
+    _remove_file(staging_path)
+    staging = sqlite3.connect(staging_path)
+    try:
+        previous = sqlite3.connect(previous_path)
+        try:
+            previous.backup(staging)
+        finally:
+            previous.close()
+        # Номер поколения только растёт, чтобы кэши, привязанные к поколению, не смешивались
+        cursor = staging.cursor()
+        _write_generation(cursor, current + 1)
+        _write_meta(cursor, {'source_hash': ''})
+        staging.commit()
+        _swap_in(staging, db_path, keep_previous=False)
+    finally:
+        staging.close()
+        _remove_file(staging_path)
+    logger.info(f"Выполнен откат индекса к предыдущему поколению, новый номер поколения {current + 1}")
+    return {'rolled_back': True, 'generation': current + 1}
+
+# Дескриптор поколения для читателей: соединение с открытой транзакцией чтения,
+# все запросы через него видят одно и то же поколение индекса. Переданное соединение
+# (например, из пула) после завершения не закрывается
+class GenerationHandle:
+    def __init__(self, db_path=DB_PATH, conn=None):
+        self.owns_conn = conn is None
+        self.conn = sqlite3.connect(db_path, timeout=30) if conn is None else conn
+        self.conn.execute('BEGIN')
+        self.generation = read_generation(self.conn)
+
+    def cursor(self):
+        return self.conn.cursor()
+
+    def close(self):
+        self.conn.rollback()
+        if self.owns_conn:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
@@ -0,0 +1,363 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import json
+import time
+import uuid
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Каталог со снимками состояния задач (их видят все процессы приложения, в том числе обработчики serve.py)
+JOBS_DIR = './jobs'
+# Сколько завершённых задач хранится
+JOBS_HISTORY = 50
+# Как часто снимок состояния записывается на диск и проверяется отмена из другого процесса (в секундах)
+SNAPSHOT_INTERVAL = 0.5
+# Интервал пустых сообщений в потоке SSE, чтобы соединение не закрывалось по простою (в секундах)
+HEARTBEAT_INTERVAL = 15
+
+FINAL_STATES = ('done', 'failed', 'cancelled')
+
+class JobCancelled(Exception):
+    pass
+
+def _pid_alive(pid):
+    if pid == os.getpid():
+        return True
+    if sys.platform == 'win32':
+        import ctypes
+        handle = ctypes.windll.kernel32.OpenProcess(0x1000, False, pid)
+        if not handle:
+            return False
+        ctypes.windll.kernel32.CloseHandle(handle)
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _write_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def _read_json(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Фоновая задача: состояние, счётчики прогресса, результат и признак отмены.
+# Функция задачи получает объект Job, сообщает прогресс через update()
+# и вызывает check_cancelled() (или track()) в местах, где её можно прервать
+class Job:
+    def __init__(self, runner, kind, key):
+        self.runner = runner
+        self.id = uuid.uuid4().hex[:12]
+        self.kind = kind
+        self.key = key
+        self.state = 'queued'
+        self.progress = {}
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.version = 0
+        self._cancel = threading.Event()
+        self._condition = threading.Condition()
+        self._saved = 0.0
+        self._cancel_checked = 0.0
+        self._rates = {}
+        self._thread = None
+
+    def snapshot(self):
+        with self._condition:
+            return {'id': self.id, 'kind': self.kind, 'state': self.state, 'progress': dict(self.progress),
+                    'result': self.result, 'error': self.error, 'created': self.created, 'started': self.started,
+                    'finished': self.finished, 'version': self.version, 'pid': os.getpid()}
+
+    def _changed(self, force=False):
+        with self._condition:
+            self.version += 1
+            self._condition.notify_all()
+        now = time.monotonic()
+        if force or now - self._saved >= SNAPSHOT_INTERVAL:
+            self._saved = now
+            self.runner._save(self)
+
+    # Обновление счётчиков. Для счётчика с известным итогом (total_<имя>) оценивается оставшееся время
+    def update(self, **progress):
+        with self._condition:
+            self.progress.update(progress)
+            now = time.monotonic()
+            for name, value in progress.items():
+                total = self.progress.get(f'total_{name}')
+                if not total or not isinstance(value, int):
+                    continue
+                # Скорость считается с первого обновления счётчика
+                first_time, first_value = self._rates.setdefault(name, (now, value))
+                rate = (value - first_value) / (now - first_time) if now > first_time else 0.0
+                self.progress['eta'] = round(max(0, total - value) / rate, 1) if rate > 0 else None
+        self._changed()
+
+    def cancel(self):
+        self._cancel.set()
+
+    @property
+    def cancelled(self):
+        if self._cancel.is_set():
+            return True
+        now = time.monotonic()
+        if now - self._cancel_checked >= SNAPSHOT_INTERVAL:
+            self._cancel_checked = now
+            # Отмена, запрошенная через другой процесс
+            if os.path.exists(self.runner._cancel_path(self.id)):
+                self._cancel.set()
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise JobCancelled()
+
+    # Обход записей с подсчётом в счётчиках counters и проверкой отмены
+    def track(self, items, *counters):
+        done = 0
+        for item in items:
+            self.check_cancelled()
+            yield item
+            done += 1
+            if done % 500 == 0:
+                self.update(**{counter: done for counter in counters})
+        self.update(**{counter: done for counter in counters})
+
+    def wait(self, version, timeout):
+        with self._condition:
+            if self.version == version and self.state not in FINAL_STATES:
+                self._condition.wait(timeout)
+            return self.version
+
+# Запуск задач в фоновых потоках. Для каждого ключа (например, 'database') одновременно
+# выполняется не больше одной задачи: повторный запрос получает уже идущую задачу.
+# Ключ занимается файлом блокировки, поэтому правило действует и между процессами
+class JobRunner:
+    def __init__(self, jobs_dir=JOBS_DIR, history=JOBS_HISTORY):
+        self.jobs_dir = jobs_dir
+        self.history = history
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def _path(self, job_id):
+        return os.path.join(self.jobs_dir, f'{job_id}.json')
+
+    def _cancel_path(self, job_id):
+        return os.path.join(self.jobs_dir, f'{job_id}.cancel')
+
+    def _lock_path(self, key):
+        return os.path.join(self.jobs_dir, f'{key}.lock')
+
+    def _save(self, job):
+        try:
+            _write_json(self._path(job.id), job.snapshot())
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить состояние задачи {job.id}: {str(e)}")
+
+    # Занятие ключа: None при успехе, иначе id задачи, которая его держит. Файл блокировки
+    # появляется сразу с содержимым (жёсткая ссылка на временный файл), поэтому его не прочитать пустым
+    def _acquire(self, key, job_id):
+        path = self._lock_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'job': job_id, 'pid': os.getpid()}, f)
+        try:
+            for _ in range(3):
+                try:
+                    os.link(tmp_path, path)
+                    return None
+                except FileExistsError:
+                    pass
+                holder = _read_json(path)
+                if holder and _pid_alive(holder.get('pid', 0)):
+                    snapshot = self.get(holder.get('job'))
+                    if snapshot is not None and snapshot['state'] not in FINAL_STATES:
+                        return holder.get('job')
+                # Блокировка осталась от завершившегося процесса или задачи
+                logger.warning(f"Снята устаревшая блокировка задач {key}")
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            raise RuntimeError(f"Не удалось занять блокировку задач {key}")
+        finally:
+            os.remove(tmp_path)
+
+    def _release(self, key, job_id):
+        holder = _read_json(self._lock_path(key))
+        if holder and holder.get('job') != job_id:
+            return
+        try:
+            os.remove(self._lock_path(key))
+        except FileNotFoundError:
+            pass
+
+    # Удаление снимков старых завершённых задач сверх JOBS_HISTORY
+    def _prune(self):
+        snapshots = [name for name in os.listdir(self.jobs_dir) if name.endswith('.json')]
+        if len(snapshots) <= self.history:
+            return
+        snapshots.sort(key=lambda name: os.path.getmtime(os.path.join(self.jobs_dir, name)))
+        for name in snapshots[:len(snapshots) - self.history]:
+            job_id = name[:-len('.json')]
+            snapshot = _read_json(self._path(job_id))
+            if snapshot and snapshot['state'] not in FINAL_STATES:
+                continue
+            for path in (self._path(job_id), self._cancel_path(job_id)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self._lock:
+                self._jobs.pop(job_id, None)
+
+    # Запуск задачи target(job) с ключом key. Возвращает (снимок задачи, создана ли новая задача)
+    def submit(self, kind, target, key=None):
+        key = key or kind
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        job = Job(self, kind, key)
+        # Снимок пишется до занятия ключа: процесс, увидевший блокировку, всегда найдёт задачу
+        self._save(job)
+        with self._lock:
+            holder = self._acquire(key, job.id)
+            if holder is not None:
+                os.remove(self._path(job.id))
+                snapshot = self.get(holder)
+                logger.info(f"Задача {kind} не запущена: уже выполняется задача {holder} ({snapshot['kind']})")
+                return snapshot, False
+            self._jobs[job.id] = job
+            job._thread = threading.Thread(target=self._run, args=(job, target), name=f'job-{kind}', daemon=True)
+        job._thread.start()
+        self._prune()
+        return job.snapshot(), True
+
+    def _run(self, job, target):
+        job.started = time.time()
+        job.state = 'running'
+        job._changed(force=True)
+        logger.info(f"Задача {job.id} ({job.kind}) запущена")
+        try:
+            job.result = target(job)
+            job.state = 'done'
+        except JobCancelled:
+            job.state = 'cancelled'
+        except Exception as e:
+            logger.error(f"Ошибка задачи {job.id} ({job.kind}): {str(e)}")
+            job.error = str(e)
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+            job._changed(force=True)
+            self._release(job.key, job.id)
+            try:
+                os.remove(self._cancel_path(job.id))
+            except FileNotFoundError:
+                pass
+            logger.info(f"Задача {job.id} ({job.kind}) завершена: {job.state} за {job.finished - job.started:.2f} с")
+
+    # Снимок задачи (своей или запущенной другим процессом), None если задача неизвестна
+    def get(self, job_id):
+        if not job_id:
+            return None
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.snapshot()
+        snapshot = _read_json(self._path(os.path.basename(job_id)))
+        if snapshot and snapshot['state'] not in FINAL_STATES and not _pid_alive(snapshot.get('pid', 0)):
+            # Процесс, выполнявший задачу, завершился
+            snapshot['state'] = 'failed'
+            snapshot['error'] = 'Процесс, выполнявший задачу, завершился'
+        return snapshot
+
+    # Идущая задача с ключом key (снимок) или None
+    def active(self, key):
+        holder = _read_json(self._lock_path(key))
+        if not holder:
+            return None
+        snapshot = self.get(holder.get('job'))
+        return snapshot if snapshot and snapshot['state'] not in FINAL_STATES else None
+
+    def list(self):
+        if not os.path.isdir(self.jobs_dir):
+            return []
+        snapshots = [self.get(name[:-len('.json')]) for name in os.listdir(self.jobs_dir) if name.endswith('.json')]
+        return sorted((snapshot for snapshot in snapshots if snapshot), key=lambda snapshot: snapshot['created'], reverse=True)
+
+    # Запрос отмены: False, если задача неизвестна или уже завершена
+    def cancel(self, job_id):
+        snapshot = self.get(job_id)
+        if snapshot is None or snapshot['state'] in FINAL_STATES:
+            return False
+        job = self._jobs.get(job_id)
+        if job is not None:
+            job.cancel()
+        else:
+            open(self._cancel_path(snapshot['id']), 'w').close()
+        logger.info(f"Запрошена отмена задачи {job_id}")
+        return True
+
+    def _running(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if job.state not in FINAL_STATES]
+
+    # Отмена всех задач этого процесса (например, по сигналу остановки)
+    def cancel_all(self):
+        for job in self._running():
+            job.cancel()
+
+    # Ожидание завершения задач этого процесса. Возвращает id задач, не завершившихся за timeout
+    def join(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        running = self._running()
+        for job in running:
+            job._thread.join(None if deadline is None else max(0.0, deadline - time.monotonic()))
+        return [job.id for job in running if job._thread.is_alive()]
+
+    # Остановка процесса: потоки задач фоновые и погибли бы вместе с ним, оставив снимок в состоянии
+    # running. Задачи отменяются и завершаются в состоянии cancelled (с сохранённым снимком)
+    def shutdown(self, timeout=None):
+        self.cancel_all()
+        unfinished = self.join(timeout)
+        for job_id in unfinished:
+            logger.warning(f"Задача {job_id} не завершилась при остановке за {timeout} с")
+        return unfinished
+
+    # Поток снимков задачи по мере изменения (до завершения); None — пустое сообщение для поддержания соединения
+    def events(self, job_id):
+        job = self._jobs.get(job_id)
+        version, state = -1, None
+        last_sent = time.monotonic()
+        while True:
+            if job is not None:
+                job.wait(version, HEARTBEAT_INTERVAL)
+            else:
+                time.sleep(SNAPSHOT_INTERVAL)
+            snapshot = self.get(job_id)
+            if snapshot is None:
+                return
+            if (snapshot['version'], snapshot['state']) != (version, state):
+                version, state = snapshot['version'], snapshot['state']
+                last_sent = time.monotonic()
+                yield snapshot
+                if snapshot['state'] in FINAL_STATES:
+                    return
+            elif time.monotonic() - last_sent >= HEARTBEAT_INTERVAL:
+                last_sent = time.monotonic()
+                yield None
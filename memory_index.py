@@ -0,0 +1,281 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import re
+import sys
+import math
+import time
+import random
+import sqlite3
+import logging
+import argparse
+import unicodedata
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Параметры bm25 (как у FTS5)
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Число слов в строке-фрагменте вокруг первого совпадения
+SNIPPET_TOKENS = 24
+
+# Слова — непрерывные последовательности букв и цифр, как у токенизатора unicode61
+TOKEN_RE = re.compile(r'[^\W_]+')
+
+# Таблица свёртки символов для str.translate: нижний регистр, удаление диакритики
+# у латиницы (café -> cafe), ς -> σ. Кириллица не меняется (й и ё остаются собой),
+# каждый символ заменяется ровно одним, поэтому позиции слов совпадают с исходным текстом
+class _FoldTable(dict):
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        folded = char.lower()
+        decomposed = unicodedata.normalize('NFD', folded)
+        if decomposed[0] < 'ɐ':
+            folded = ''.join(c for c in decomposed if unicodedata.category(c) != 'Mn') or folded
+        if folded == 'ς':
+            folded = 'σ'
+        if len(folded) != 1:
+            folded = char.lower() if len(char.lower()) == 1 else char
+        self[codepoint] = folded
+        return folded
+
+FOLD_TABLE = _FoldTable()
+
+def fold_text(text):
+    return text.translate(FOLD_TABLE)
+
+def tokenize(text):
+    return TOKEN_RE.findall(fold_text(text))
+
+# Разбор запроса в синтаксисе FTS5 после normalize_text: слова и фразы в кавычках
+# (внутри фразы "" означает кавычку). Возвращает список фраз, каждая — список слов;
+# пустые фразы отбрасываются. Незакрытая кавычка — ошибка, как в FTS5
+def parse_query(query):
+    phrases = []
+    position = 0
+    length = len(query)
+    while position < length:
+        char = query[position]
+        if char.isspace():
+            position += 1
+        elif char == '"':
+            parts = []
+            position += 1
+            while True:
+                end = query.find('"', position)
+                if end < 0:
+                    raise ValueError('unterminated string')
+                parts.append(query[position:end])
+                if query.startswith('""', end):
+                    parts.append('"')
+                    position = end + 2
+                    continue
+                position = end + 1
+                break
+            phrases.append(tokenize(''.join(parts)))
+        else:
+            end = position
+            while end < length and not query[end].isspace() and query[end] != '"':
+                end += 1
+            phrases.append(tokenize(query[position:end]))
+            position = end
+    return [phrase for phrase in phrases if phrase]
+
+# Инвертированный индекс материалов в памяти процесса. Словарь слов -> номер слова,
+# списки документов по словам (postings) и частоты слов хранятся в общих массивах numpy
+# со смещениями; последовательности слов документов — для проверки фраз в кавычках
+class MemoryIndex:
+    def __init__(self, rows):
+        start = time.perf_counter()
+        self.ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.dates = [row[1] for row in rows]
+        self.texts = [row[2] for row in rows]
+        self.vocabulary = {}
+        doc_terms = []
+        pair_terms, pair_counts, pair_docs = [], [], []
+        for doc, text in enumerate(self.texts):
+            terms = np.array([self.vocabulary.setdefault(token, len(self.vocabulary)) for token in tokenize(text)], dtype=np.int32)
+            doc_terms.append(terms)
+            unique_terms, counts = np.unique(terms, return_counts=True)
+            pair_terms.append(unique_terms)
+            pair_counts.append(counts)
+            pair_docs.append(np.full(len(unique_terms), doc, dtype=np.int32))
+        self.doc_lengths = np.array([len(terms) for terms in doc_terms], dtype=np.int32)
+        self.doc_offsets = np.concatenate(([0], np.cumsum(self.doc_lengths))).astype(np.int64)
+        self.doc_terms = np.concatenate(doc_terms) if doc_terms else np.empty(0, dtype=np.int32)
+        terms = np.concatenate(pair_terms) if pair_terms else np.empty(0, dtype=np.int32)
+        order = np.argsort(terms, kind='stable')
+        self.postings = (np.concatenate(pair_docs) if pair_docs else np.empty(0, dtype=np.int32))[order]
+        self.frequencies = (np.concatenate(pair_counts) if pair_counts else np.empty(0, dtype=np.int64))[order].astype(np.int32)
+        self.posting_offsets = np.concatenate(([0], np.cumsum(np.bincount(terms, minlength=len(self.vocabulary))))).astype(np.int64)
+        self.average_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+        logger.info(f"Индекс в памяти построен за {time.perf_counter() - start:.2f} с: {len(self.ids)} материалов, "
+                    f"{len(self.vocabulary)} слов, {self.nbytes() / 1024 / 1024:.1f} МиБ массивов")
+
+    # Загрузка материалов из базы (курсор открытого поколения)
+    @classmethod
+    def from_cursor(cls, cursor):
+        cursor.execute('SELECT id, date, material FROM restricted_materials ORDER BY id')
+        return cls(cursor.fetchall())
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.ids, self.doc_lengths, self.doc_offsets, self.doc_terms,
+                                              self.postings, self.frequencies, self.posting_offsets))
+
+    def _posting(self, term):
+        return slice(self.posting_offsets[term], self.posting_offsets[term + 1])
+
+    # Номера документов, содержащих все слова и фразы запроса, по убыванию bm25
+    def search(self, phrases):
+        if not phrases:
+            return np.empty(0, dtype=np.int32)
+        term_phrases = []
+        for phrase in phrases:
+            terms = [self.vocabulary.get(token) for token in phrase]
+            if None in terms:
+                return np.empty(0, dtype=np.int32)
+            term_phrases.append(terms)
+        distinct = sorted({term for terms in term_phrases for term in terms},
+                          key=lambda term: self.posting_offsets[term + 1] - self.posting_offsets[term])
+        candidates = self.postings[self._posting(distinct[0])]
+        for term in distinct[1:]:
+            if not len(candidates):
+                break
+            candidates = np.intersect1d(candidates, self.postings[self._posting(term)], assume_unique=True)
+        multi_word = [terms for terms in term_phrases if len(terms) > 1]
+        if multi_word and len(candidates):
+            candidates = self._filter_phrases(candidates, multi_word)
+        if len(candidates) < 2:
+            return candidates
+        return candidates[np.argsort(-self._bm25(distinct, candidates), kind='stable')]
+
+    # Оставляет документы, где каждая фраза встречается подряд. Слова всех кандидатов
+    # собираются в один массив, и совпадение фразы ищется сдвинутыми сравнениями
+    # без цикла по документам; фраза не может переходить границу документа
+    def _filter_phrases(self, docs, phrases):
+        lengths = self.doc_lengths[docs].astype(np.int64)
+        total = int(lengths.sum())
+        owners = np.repeat(np.arange(len(docs)), lengths)
+        positions = np.arange(total) + np.repeat(self.doc_offsets[docs] - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        stream = self.doc_terms[positions]
+        keep = np.ones(len(docs), dtype=bool)
+        for phrase in phrases:
+            size = total - len(phrase) + 1
+            if size <= 0:
+                return docs[:0]
+            mask = owners[:size] == owners[len(phrase) - 1:]
+            for offset, term in enumerate(phrase):
+                mask &= stream[offset:offset + size] == term
+            found = np.zeros(len(docs), dtype=bool)
+            found[owners[:size][mask]] = True
+            keep &= found
+        return docs[keep]
+
+    def _bm25(self, terms, docs):
+        total = len(self.ids)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[docs] / self.average_length)
+        scores = np.zeros(len(docs), dtype=np.float64)
+        for term in terms:
+            posting = self._posting(term)
+            term_docs = self.postings[posting]
+            idf = max(math.log((total - len(term_docs) + 0.5) / (len(term_docs) + 0.5)), 1e-6)
+            tf = self.frequencies[posting][np.searchsorted(term_docs, docs)]
+            scores += idf * tf * (BM25_K1 + 1) / (tf + norm)
+        return scores
+
+    # Фрагмент текста документа вокруг первого совпадения; слова запроса обрамляются маркерами
+    def snippet(self, doc, phrases, open_mark, close_mark, ellipsis='…', tokens=SNIPPET_TOKENS):
+        text = self.texts[doc]
+        query_tokens = {token for phrase in phrases for token in phrase}
+        spans = [(match.start(), match.end(), match.group() in query_tokens) for match in TOKEN_RE.finditer(fold_text(text))]
+        if not spans:
+            return text
+        first = next((position for position, span in enumerate(spans) if span[2]), 0)
+        begin = max(0, min(first - tokens // 4, len(spans) - tokens))
+        window = spans[begin:begin + tokens]
+        parts = [ellipsis] if begin > 0 else []
+        cursor = window[0][0]
+        for span_start, span_end, matched in window:
+            parts.append(text[cursor:span_start])
+            parts.append(open_mark + text[span_start:span_end] + close_mark if matched else text[span_start:span_end])
+            cursor = span_end
+        parts.append(text[cursor:] if begin + tokens >= len(spans) else ellipsis)
+        return ''.join(parts)
+
+# Нормализация запроса так же, как normalize_text в run.py
+def _normalize(text):
+    text = re.sub(r'[^\w\s"]', '', text.lower())
+    return re.sub(r'\s+', ' ', text).strip()
+
+# Набор запросов для сверки с FTS5: слова, пары слов одного и разных материалов,
+# фразы в кавычках, фраза со словом и заведомо отсутствующие слова
+def _sample_queries(texts, count, seed):
+    rng = random.Random(seed)
+    words = [text.split() for text in texts if text.split()]
+    queries = []
+    for _ in range(count):
+        doc = rng.choice(words)
+        other = rng.choice(words)
+        start = rng.randrange(len(doc))
+        queries.append(_normalize(rng.choice(doc)))
+        queries.append(_normalize(f"{rng.choice(doc)} {rng.choice(doc)}"))
+        queries.append(_normalize(f"{rng.choice(doc)} {rng.choice(other)}"))
+        queries.append(_normalize('"' + ' '.join(doc[start:start + rng.randint(2, 4)]).replace('"', '') + '"'))
+        queries.append(_normalize('"' + ' '.join(doc[start:start + 2]).replace('"', '') + '" ' + rng.choice(other)))
+        queries.append(_normalize(rng.choice(doc) + 'щъ'))
+    return [query for query in queries if query]
+
+def _fts_ids(cursor, query):
+    try:
+        cursor.execute('SELECT id FROM restricted_materials_fts WHERE material MATCH ?', (query,))
+        return {int(row[0]) for row in cursor.fetchall()}
+    except sqlite3.Error:
+        return None
+
+def _memory_ids(index, query):
+    try:
+        return set(index.ids[index.search(parse_query(query))].tolist())
+    except ValueError:
+        return None
+
+# Сверка результатов с FTS5 (python memory_index.py parity) и замер задержек (... bench)
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Индекс материалов в памяти: сверка с FTS5 и замер задержек')
+    parser.add_argument('command', choices=['parity', 'bench'])
+    parser.add_argument('--db', default='./restricted.db')
+    parser.add_argument('--queries', type=int, default=500, help='число групп запросов (по 6 запросов в группе)')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    conn = sqlite3.connect(args.db)
+    cursor = conn.cursor()
+    index = MemoryIndex.from_cursor(cursor)
+    queries = _sample_queries(index.texts, args.queries, args.seed)
+    if args.command == 'parity':
+        mismatches = 0
+        for query in queries:
+            expected, actual = _fts_ids(cursor, query), _memory_ids(index, query)
+            if expected != actual:
+                mismatches += 1
+                if mismatches <= 20:
+                    print(f"Расхождение для {query!r}: FTS5 {sorted(expected) if expected is not None else 'ошибка'}, "
+                          f"в памяти {sorted(actual) if actual is not None else 'ошибка'}")
+        matched = sum(1 for query in queries if _fts_ids(cursor, query))
+        print(f"Запросов: {len(queries)}, с совпадениями: {matched}, расхождений: {mismatches}")
+        return 1 if mismatches else 0
+    timings = {}
+    for name, check in (('fts5', lambda query: _fts_ids(cursor, query)), ('memory', lambda query: _memory_ids(index, query))):
+        samples = []
+        for query in queries:
+            start = time.perf_counter()
+            check(query)
+            samples.append((time.perf_counter() - start) * 1e6)
+        timings[name] = np.array(samples)
+        print(f"{name:>6}: среднее {timings[name].mean():8.1f} мкс, медиана {np.percentile(timings[name], 50):8.1f} мкс, "
+              f"p99 {np.percentile(timings[name], 99):8.1f} мкс, {len(queries) / timings[name].sum() * 1e6:8.0f} запросов/с")
+    print(f"Ускорение по среднему: {timings['fts5'].mean() / timings['memory'].mean():.1f}x, память индекса {index.nbytes() / 1024 / 1024:.1f} МиБ")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
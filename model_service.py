@@ -0,0 +1,267 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import time
+import secrets
+import logging
+import argparse
+import threading
+from multiprocessing.connection import Listener, Client
+import numpy as np
+from batch_encoder import BatchingEncoder
+
+logger = logging.getLogger(__name__)
+
+MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+# Адрес службы: Unix-сокет, на Windows — именованный канал
+SERVICE_ADDRESS = r'\\.\pipe\berkut-model-service' if sys.platform == 'win32' else './model_service.sock'
+# Файл с ключом подключения (создаётся службой при запуске, доступен только владельцу)
+SERVICE_KEY_FILE = './model_service.key'
+# Переменная окружения с адресом службы: если задана, приложения не загружают модель сами
+SERVICE_ENV = 'BERKUT_MODEL_SERVICE'
+# Окно ожидания (мс) и максимальный размер пакета при кодировании запросов разных клиентов
+SERVICE_MAX_WAIT_MS = 5
+SERVICE_MAX_BATCH = 32
+# Время ожидания ответа службы (в секундах)
+SERVICE_TIMEOUT = 30
+# Число текстов в одном запросе кодирования: большие списки (например, весь корпус при построении
+# хранилища эмбеддингов) отправляются частями, чтобы каждая укладывалась в SERVICE_TIMEOUT
+SERVICE_ENCODE_BATCH = 128
+
+def _family(address):
+    return 'AF_PIPE' if address.startswith('\\\\') else 'AF_UNIX'
+
+# Служба модели: одна копия модели на все процессы приложения. Запросы разных клиентов
+# кодируются общими пакетами; пока модель загружается, служба уже отвечает на проверку готовности
+class ModelService:
+    def __init__(self, model_name=MODEL_NAME, address=SERVICE_ADDRESS, key_file=SERVICE_KEY_FILE,
+                 max_batch_size=SERVICE_MAX_BATCH, max_wait_ms=SERVICE_MAX_WAIT_MS):
+        self.model_name = model_name
+        self.address = address
+        self.key_file = key_file
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.encoder = None
+        self.dimension = None
+        self.error = None
+        self.started = time.time()
+        self.stats = {'connections': 0, 'requests': 0, 'texts': 0}
+        self._ready = threading.Event()
+
+    def _load_model(self):
+        start = time.perf_counter()
+        try:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(self.model_name)
+            self.dimension = model.get_sentence_embedding_dimension()
+            self.encoder = BatchingEncoder(model, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait_ms)
+            logger.info(f"Модель {self.model_name} загружена за {time.perf_counter() - start:.2f} с")
+        except Exception as e:
+            self.error = str(e)
+            logger.error(f"Ошибка загрузки модели {self.model_name}: {str(e)}")
+        self._ready.set()
+
+    def health(self):
+        return {'ready': self.encoder is not None, 'loading': not self._ready.is_set(), 'error': self.error,
+                'model': self.model_name, 'dimension': self.dimension, 'pid': os.getpid(),
+                'uptime': round(time.time() - self.started, 1), 'stats': dict(self.stats),
+                'batches': dict(self.encoder.stats) if self.encoder is not None else None}
+
+    def _encode(self, texts):
+        if not self._ready.wait(SERVICE_TIMEOUT) or self.encoder is None:
+            raise RuntimeError(self.error or 'Модель ещё загружается')
+        futures = [self.encoder.submit(text) for text in texts]
+        self.stats['texts'] += len(texts)
+        if not futures:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+        return np.stack([future.result(SERVICE_TIMEOUT) for future in futures])
+
+    def _handle(self, conn):
+        self.stats['connections'] += 1
+        try:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                self.stats['requests'] += 1
+                try:
+                    if message.get('op') == 'health':
+                        conn.send({'ok': True, 'health': self.health()})
+                    elif message.get('op') == 'encode':
+                        conn.send({'ok': True, 'embeddings': self._encode(list(message['texts']))})
+                    else:
+                        conn.send({'ok': False, 'error': f"Неизвестная операция: {message.get('op')}"})
+                except (EOFError, OSError):
+                    return
+                except Exception as e:
+                    logger.error(f"Ошибка обработки запроса к службе модели: {str(e)}")
+                    conn.send({'ok': False, 'error': str(e)})
+        finally:
+            conn.close()
+
+    # Ключ подключения: случайный при каждом запуске, файл доступен только владельцу
+    def _write_key(self):
+        authkey = secrets.token_bytes(32)
+        tmp_path = self.key_file + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(authkey)
+        os.replace(tmp_path, self.key_file)
+        return authkey
+
+    # Удаление сокета, оставшегося от завершившейся службы (действующую службу не трогаем)
+    def _remove_stale_socket(self):
+        if _family(self.address) != 'AF_UNIX' or not os.path.exists(self.address):
+            return
+        try:
+            Client(self.address, family='AF_UNIX', authkey=read_service_key(self.key_file)).close()
+        except Exception:
+            os.remove(self.address)
+            return
+        raise RuntimeError(f"Служба модели уже запущена по адресу {self.address}")
+
+    def serve_forever(self):
+        self._remove_stale_socket()
+        listener = Listener(self.address, family=_family(self.address), authkey=self._write_key())
+        logger.info(f"Служба модели слушает {self.address}")
+        threading.Thread(target=self._load_model, name='model-loader', daemon=True).start()
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # Клиент с неверным ключом или оборванное подключение
+                    logger.warning(f"Отклонено подключение к службе модели: {str(e)}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), name='model-client', daemon=True).start()
+        finally:
+            listener.close()
+
+def read_service_key(key_file=SERVICE_KEY_FILE):
+    with open(key_file, 'rb') as f:
+        return f.read()
+
+# Клиент службы модели с интерфейсом SentenceTransformer.encode: может использоваться вместо модели
+# (в том числе в BatchingEncoder). Каждый поток держит своё подключение и переподключается после обрыва
+class ModelServiceClient:
+    def __init__(self, address=SERVICE_ADDRESS, key_file=SERVICE_KEY_FILE, timeout=SERVICE_TIMEOUT,
+                 encode_batch=SERVICE_ENCODE_BATCH):
+        self.address = address
+        self.key_file = key_file
+        self.timeout = timeout
+        self.encode_batch = encode_batch
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(self.address, family=_family(self.address), authkey=read_service_key(self.key_file))
+            self._local.conn = conn
+        return conn
+
+    def _drop_connection(self):
+        conn = getattr(self._local, 'conn', None)
+        self._local.conn = None
+        if conn is not None:
+            try:
+                conn.close()
+            except OSError:
+                pass
+
+    def _request(self, message, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send(message)
+                if not conn.poll(timeout):
+                    self._drop_connection()
+                    raise TimeoutError(f"Служба модели не ответила за {timeout} с")
+                response = conn.recv()
+                break
+            except (EOFError, ConnectionError, BrokenPipeError) as e:
+                # Служба могла перезапуститься: одна повторная попытка с новым подключением
+                self._drop_connection()
+                if attempt:
+                    raise ConnectionError(f"Служба модели недоступна: {str(e)}")
+        if not response['ok']:
+            raise RuntimeError(response['error'])
+        return response
+
+    def encode(self, texts, batch_size=None, normalize_embeddings=True, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        # Служба всегда возвращает нормализованные векторы float32
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        parts = []
+        for start in range(0, max(len(texts), 1), self.encode_batch):
+            chunk = texts[start:start + self.encode_batch]
+            try:
+                parts.append(self._request({'op': 'encode', 'texts': chunk})['embeddings'])
+            except TimeoutError:
+                raise TimeoutError(f"Служба модели не закодировала {len(chunk)} текстов (с {start} из {len(texts)}) "
+                                   f"за {self.timeout} с: уменьшите SERVICE_ENCODE_BATCH или увеличьте SERVICE_TIMEOUT")
+        embeddings = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return embeddings[0] if single else embeddings
+
+    def health(self, timeout=5):
+        return self._request({'op': 'health'}, timeout)['health']
+
+    def get_sentence_embedding_dimension(self):
+        return self.health()['dimension']
+
+    # Ожидание готовности службы (модель загружена); False по истечении времени или при ошибке загрузки
+    def wait_ready(self, timeout=SERVICE_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                health = self.health()
+                if health['ready']:
+                    return True
+                if health['error']:
+                    logger.error(f"Служба модели не готова: {health['error']}")
+                    return False
+            except (OSError, EOFError, RuntimeError, TimeoutError):
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.2)
+
+# Модель для кодирования запросов: клиент службы, если в окружении задан её адрес, иначе своя копия
+def load_model(model_name=MODEL_NAME):
+    address = os.environ.get(SERVICE_ENV)
+    if address:
+        client = ModelServiceClient(address, os.environ.get(SERVICE_ENV + '_KEY', SERVICE_KEY_FILE))
+        if client.wait_ready():
+            logger.info(f"Используется служба модели {address}")
+            return client
+        logger.warning(f"Служба модели {address} недоступна, модель загружается в процессе")
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(model_name)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Служба модели эмбеддингов для всех процессов приложения')
+    parser.add_argument('command', choices=['serve', 'health'])
+    parser.add_argument('--address', default=SERVICE_ADDRESS)
+    parser.add_argument('--key-file', default=SERVICE_KEY_FILE)
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--max-batch', type=int, default=SERVICE_MAX_BATCH)
+    parser.add_argument('--max-wait-ms', type=float, default=SERVICE_MAX_WAIT_MS)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.command == 'serve':
+        ModelService(args.model, args.address, args.key_file, args.max_batch, args.max_wait_ms).serve_forever()
+        return 0
+    # Проверка готовности: код 0, если модель загружена и служба отвечает
+    try:
+        health = ModelServiceClient(args.address, args.key_file).health()
+    except Exception as e:
+        print(f"Служба модели недоступна: {str(e)}")
+        return 2
+    print(health)
+    return 0 if health['ready'] else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
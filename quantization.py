@@ -0,0 +1,219 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import sys
+import gc
+import time
+import random
+import logging
+import argparse
+import numpy as np
+from embeddings import EMBEDDINGS_DIR
+
+logger = logging.getLogger(__name__)
+
+# Поддерживаемые форматы хранения матрицы эмбеддингов
+EMBEDDING_DTYPES = ('float32', 'float16', 'int8')
+# Размер блока строк, переводимого во float32 при вычислении сходства
+CHUNK_ROWS = 1024
+
+# Матрица эмбеддингов в компактном виде: float16 или int8 с масштабом на каждую строку
+# (строка = data * scale). Поддерживает операции, которые нужны поиску: shape, выборку
+# строк и умножение на вектор запроса. Умножение идёт блоками по CHUNK_ROWS строк, поэтому
+# float32-копия всей матрицы в памяти не создаётся
+class QuantizedMatrix:
+    def __init__(self, data, scales=None):
+        self.data = data
+        self.scales = scales
+
+    @property
+    def dtype_name(self):
+        return 'int8' if self.scales is not None else str(self.data.dtype)
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __getitem__(self, rows):
+        if isinstance(rows, (int, np.integer)):
+            return self[rows:rows + 1 or None]._block(0, None)[0]
+        return QuantizedMatrix(self.data[rows], self.scales[rows] if self.scales is not None else None)
+
+    def _block(self, start, stop):
+        block = np.asarray(self.data[start:stop], dtype=np.float32)
+        if self.scales is not None:
+            block *= self.scales[start:stop, None]
+        return block
+
+    def __array__(self, dtype=None, copy=None):
+        block = self._block(0, None)
+        return block.astype(dtype) if dtype is not None else block
+
+    def __matmul__(self, query_embedding):
+        query_embedding = np.asarray(query_embedding, dtype=np.float32)
+        rows = self.data.shape[0]
+        result = np.empty((rows,) + query_embedding.shape[1:], dtype=np.float32)
+        for start in range(0, rows, CHUNK_ROWS):
+            block = np.asarray(self.data[start:start + CHUNK_ROWS], dtype=np.float32) @ query_embedding
+            if self.scales is not None:
+                scales = self.scales[start:start + CHUNK_ROWS]
+                block *= scales.reshape(scales.shape + (1,) * (block.ndim - 1))
+            result[start:start + CHUNK_ROWS] = block
+        return result
+
+# Квантование нормализованной матрицы float32: float16 — приведение типа,
+# int8 — симметричное квантование строки по её максимальному модулю
+def quantize(matrix, dtype):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if dtype == 'float16':
+        return QuantizedMatrix(matrix.astype(np.float16))
+    if dtype == 'int8':
+        peaks = np.abs(matrix).max(axis=1) if matrix.shape[1] else np.zeros(matrix.shape[0], dtype=np.float32)
+        scales = np.where(peaks > 0, peaks / 127, 1).astype(np.float32)
+        data = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+        return QuantizedMatrix(data, scales)
+    raise ValueError(f"Неподдерживаемый формат эмбеддингов: {dtype}")
+
+def _quantized_paths(key, dtype):
+    return {
+        'data': os.path.join(EMBEDDINGS_DIR, f'{key}.{dtype}.npy'),
+        'scales': os.path.join(EMBEDDINGS_DIR, f'{key}.{dtype}.scales.npy'),
+    }
+
+# Функция для сохранения квантованной матрицы рядом с хранилищем поколения
+def save_quantized_matrix(key, quantized):
+    os.makedirs(EMBEDDINGS_DIR, exist_ok=True)
+    paths = _quantized_paths(key, quantized.dtype_name)
+    arrays = {'data': quantized.data, 'scales': quantized.scales}
+    for name in ('scales', 'data'):
+        if arrays[name] is None:
+            continue
+        tmp_path = f"{paths[name]}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            np.save(f, arrays[name])
+        os.replace(tmp_path, paths[name])
+
+# Функция для загрузки квантованной матрицы (отображается в память), None если её нет
+def load_quantized_matrix(key, dtype):
+    paths = _quantized_paths(key, dtype)
+    if not os.path.exists(paths['data']) or (dtype == 'int8' and not os.path.exists(paths['scales'])):
+        return None
+    try:
+        scales = np.load(paths['scales']) if dtype == 'int8' else None
+        return QuantizedMatrix(np.load(paths['data'], mmap_mode='r'), scales)
+    except Exception as e:
+        logger.error(f"Ошибка загрузки матрицы {dtype} {key[:12]}: {str(e)}")
+        return None
+
+# Функция для получения матрицы поколения в заданном формате (квантование при первом обращении).
+# Для float32 возвращается исходная матрица
+def get_quantized_matrix(key, matrix, dtype):
+    if dtype == 'float32':
+        return matrix
+    quantized = load_quantized_matrix(key, dtype)
+    if quantized is not None and quantized.shape == matrix.shape:
+        return quantized
+    start = time.perf_counter()
+    save_quantized_matrix(key, quantize(matrix, dtype))
+    quantized = load_quantized_matrix(key, dtype)
+    logger.info(f"Матрица эмбеддингов {key[:12]} сохранена в формате {dtype} за {time.perf_counter() - start:.2f} с: "
+                f"{quantized.nbytes / 1024 / 1024:.1f} МиБ вместо {matrix.nbytes / 1024 / 1024:.1f} МиБ")
+    return quantized
+
+# Резидентная память процесса в байтах (Linux; None, если не удаётся определить)
+def _resident_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+# Запросы для замера полноты: фрагменты текстов материалов по 3-8 слов
+def _sample_queries(texts, count, seed):
+    rng = random.Random(seed)
+    words = [text.split() for text in texts if len(text.split()) >= 3]
+    queries = []
+    for _ in range(count):
+        doc = rng.choice(words)
+        length = min(len(doc), rng.randint(3, 8))
+        start = rng.randrange(len(doc) - length + 1)
+        queries.append(' '.join(doc[start:start + length]))
+    return queries
+
+def _top_ids(ids, scores, threshold, top_k):
+    order = np.argsort(-scores, kind='stable')[:top_k]
+    return {int(ids[i]) for i in order}, {int(ids[i]) for i in np.flatnonzero(scores > threshold)}
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Квантованные эмбеддинги: полнота относительно float32 и расход памяти')
+    parser.add_argument('command', choices=['recall', 'memory'])
+    parser.add_argument('--db', default='./restricted.db')
+    parser.add_argument('--model', default='paraphrase-multilingual-MiniLM-L12-v2')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--threshold', type=float, default=0.7)
+    parser.add_argument('--top-k', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    from model_service import load_model
+    from embeddings import get_embedding_matrix, get_materials, encode_texts
+    model = load_model(args.model)
+    store = get_embedding_matrix(model, args.db)
+    key, ids = store['key'], store['ids']
+    if args.command == 'recall':
+        matrix = np.asarray(store['matrix'], dtype=np.float32)
+        texts = [material_text for _, _, material_text in get_materials(args.db)]
+        query_embeddings = encode_texts(model, _sample_queries(texts, args.queries, args.seed))
+        exact_scores = matrix @ query_embeddings.T
+        for dtype in EMBEDDING_DTYPES[1:]:
+            quantized = get_quantized_matrix(key, matrix, dtype)
+            start = time.perf_counter()
+            scores = quantized @ query_embeddings.T
+            elapsed = (time.perf_counter() - start) * 1000
+            top_found = top_expected = found = expected = 0
+            for column in range(query_embeddings.shape[0]):
+                exact_top, exact_hits = _top_ids(ids, exact_scores[:, column], args.threshold, args.top_k)
+                top, hits = _top_ids(ids, scores[:, column], args.threshold, args.top_k)
+                top_found += len(exact_top & top)
+                top_expected += len(exact_top)
+                found += len(exact_hits & hits)
+                expected += len(exact_hits)
+            error = np.abs(scores - exact_scores).max() if scores.size else 0.0
+            print(f"{dtype:>8}: полнота top-{args.top_k} {top_found / max(1, top_expected):.4f}, "
+                  f"полнота выше порога {args.threshold} {found / expected if expected else 1.0:.4f} ({expected} совпадений), "
+                  f"макс. отклонение сходства {error:.5f}, {elapsed / max(1, query_embeddings.shape[0]):.3f} мс/запрос")
+        return 0
+    # Замер резидентной памяти: матрица каждого формата отображается в память и просматривается целиком
+    query_embedding = np.asarray(store['matrix'][0], dtype=np.float32) if len(ids) else None
+    for dtype in EMBEDDING_DTYPES:
+        get_quantized_matrix(key, store['matrix'], dtype)
+    del store
+    gc.collect()
+    for dtype in EMBEDDING_DTYPES:
+        before = _resident_bytes()
+        if dtype == 'float32':
+            matrix = np.load(os.path.join(EMBEDDINGS_DIR, f'{key}.npy'), mmap_mode='r')
+        else:
+            matrix = load_quantized_matrix(key, dtype)
+        start = time.perf_counter()
+        if query_embedding is not None:
+            matrix @ query_embedding
+        elapsed = (time.perf_counter() - start) * 1000
+        after = _resident_bytes()
+        resident = f"{(after - before) / 1024 / 1024:.1f} МиБ" if before is not None and after is not None else 'н/д'
+        print(f"{dtype:>8}: размер {matrix.nbytes / 1024 / 1024:.1f} МиБ, прирост резидентной памяти {resident}, "
+              f"полный просмотр {elapsed:.2f} мс")
+        del matrix
+        gc.collect()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import hashlib
+import logging
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Каталог для кэша последней загруженной версии реестра
+CACHE_DIR = './cache'
+# Размер блока при потоковой загрузке
+CHUNK_SIZE = 64 * 1024
+REQUEST_TIMEOUT = 30
+HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+
+def _cache_paths(cache_dir):
+    return os.path.join(cache_dir, 'registry.payload'), os.path.join(cache_dir, 'registry.json')
+
+def _load_state(cache_dir):
+    payload_path, state_path = _cache_paths(cache_dir)
+    try:
+        with open(state_path, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        return state if os.path.exists(payload_path) else {}
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        logger.error(f"Ошибка чтения состояния кэша реестра: {str(e)}")
+        return {}
+
+def _save_state(cache_dir, state):
+    _, state_path = _cache_paths(cache_dir)
+    try:
+        with open(state_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+    except Exception as e:
+        logger.error(f"Ошибка сохранения состояния кэша реестра: {str(e)}")
+
+# Загрузка реестра с условным GET (If-None-Match / If-Modified-Since). Тело ответа
+# читается потоком: каждый блок сразу хэшируется, пишется в кэш и отдаётся разбору.
+# При ответе 304 данные читаются из кэша без повторной загрузки
+class RegistryDownload:
+    def __init__(self, url, cache_dir=CACHE_DIR, session=None, timeout=REQUEST_TIMEOUT, verify=False):
+        self.url = url
+        self.cache_dir = cache_dir
+        self.hash = None
+        self.not_modified = False
+        state = _load_state(cache_dir)
+        headers = dict(HEADERS)
+        if state.get('url') == url:
+            if state.get('etag'):
+                headers['If-None-Match'] = state['etag']
+            if state.get('last_modified'):
+                headers['If-Modified-Since'] = state['last_modified']
+        if not verify:
+            logger.warning("SSL verification disabled for remote CSV fetch due to certificate issues")
+        self.response = (session or requests).get(url, headers=headers, stream=True, timeout=timeout, verify=verify)
+        if self.response.status_code == 304 and state.get('url') == url:
+            self.not_modified = True
+            self.hash = state.get('hash')
+            self.response.close()
+            logger.info(f"Реестр {url} не изменился (304), используется кэш")
+        else:
+            self.response.raise_for_status()
+
+    # Поток байтовых блоков реестра; после полного чтения заполняется self.hash
+    def iter_chunks(self):
+        payload_path, _ = _cache_paths(self.cache_dir)
+        if self.not_modified:
+            with open(payload_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    yield chunk
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        sha256 = hashlib.sha256()
+        tmp_path = payload_path + '.tmp'
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in self.response.iter_content(CHUNK_SIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+                    yield chunk
+        finally:
+            self.response.close()
+        os.replace(tmp_path, payload_path)
+        self.hash = sha256.hexdigest()
+        _save_state(self.cache_dir, {
+            'url': self.url,
+            'etag': self.response.headers.get('ETag'),
+            'last_modified': self.response.headers.get('Last-Modified'),
+            'hash': self.hash,
+        })
+
+    def close(self):
+        self.response.close()
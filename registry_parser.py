@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import re
+import csv
+import codecs
+import hashlib
+import logging
+from registry_fetcher import RegistryDownload
+
+logger = logging.getLogger(__name__)
+
+# Размер блока при чтении локального файла
+CHUNK_SIZE = 64 * 1024
+# Разделитель записей в TXT-выгрузке
+TXT_MARKER = 'Экстремистский материал №'
+# Заголовок CSV-выгрузки Минюста: #;Материал;Дата включения (указывается с 01.01.2017)
+CSV_HEADER = ('#', 'Материал', 'Дата')
+
+# Функция для определения кодировки по началу файла (UTF-8 или windows-1251)
+def detect_encoding(prefix):
+    if prefix.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    try:
+        prefix.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # Многобайтовый символ мог быть обрезан на границе блока
+        if e.start >= len(prefix) - 3 and e.reason == 'unexpected end of data':
+            return 'utf-8'
+        return 'windows-1251'
+
+# Функция для построчного декодирования потока байтовых блоков (кодировка определяется по первому блоку)
+def iter_text_lines(chunks, encoding=None):
+    decoder = None
+    buffer = ''
+    for chunk in chunks:
+        if decoder is None:
+            encoding = encoding or detect_encoding(chunk)
+            logger.info(f"Кодировка источника: {encoding}")
+            decoder = codecs.getincrementaldecoder(encoding)()
+        buffer += decoder.decode(chunk)
+        lines = buffer.split('\n')
+        # Последняя строка может продолжиться в следующем блоке
+        buffer = lines.pop()
+        for line in lines:
+            yield line + '\n'
+    if decoder is not None:
+        buffer += decoder.decode(b'', final=True)
+    if buffer:
+        yield buffer
+
+def _parse_txt_entry(entry):
+    match = re.match(r'(\d+): (.+)', entry, re.DOTALL)
+    if not match:
+        logger.warning(f"Не удалось разобрать запись: {entry[:50]}...")
+        return None
+    date_match = re.search(r'\(решение .+? от ([0-9.]+)\)?', entry)
+    date = date_match.group(1) if date_match else "Не указана"
+    return int(match.group(1)), date, match.group(2).strip()
+
+# Разбор TXT-выгрузки: записи начинаются с «Экстремистский материал №<id>: »
+# и могут занимать несколько строк; текст до первой записи пропускается
+def iter_txt_materials(lines):
+    entry = None
+    for line in lines:
+        parts = line.split(TXT_MARKER)
+        if entry is not None:
+            entry.append(parts[0])
+        for part in parts[1:]:
+            if entry is not None:
+                material = _parse_txt_entry(''.join(entry))
+                if material:
+                    yield material
+            entry = [part]
+    if entry is not None:
+        material = _parse_txt_entry(''.join(entry))
+        if material:
+            yield material
+
+# Разбор CSV-выгрузки Минюста (разделитель «;», поля в кавычках могут содержать переводы строк)
+def iter_csv_materials(lines):
+    csv_reader = csv.reader(lines, delimiter=';')
+    header = next(csv_reader, None)
+    if not (header and len(header) >= 3 and all(header[i].strip().startswith(CSV_HEADER[i]) for i in range(3))):
+        logger.error(f"Некорректный заголовок CSV: {header}")
+        raise ValueError("Некорректный формат CSV")
+    for row in csv_reader:
+        if len(row) >= 3 and row[0].strip().isdigit():
+            material_text = row[1].strip() if row[1].strip() else "Не указано"
+            date = row[2].strip() if row[2].strip() else "Не указана"
+            yield int(row[0].strip()), date, material_text
+        else:
+            logger.warning(f"Некорректная строка CSV: {row}")
+
+# Источник реестра (txt, local_csv или remote_csv): байты читаются блоками, хэшируются
+# на лету и разбираются в поток записей (id, date, material) без загрузки файла целиком
+class RegistrySource:
+    def __init__(self, db_source, db_path, download=None):
+        if db_source not in ('txt', 'local_csv', 'remote_csv'):
+            raise ValueError(f"Неизвестный источник базы: {db_source}")
+        self.db_source = db_source
+        self.db_path = db_path
+        self.download = download
+        self.hash = None
+
+    def iter_chunks(self):
+        if self.db_source == 'remote_csv':
+            self.download = self.download or RegistryDownload(self.db_path)
+            yield from self.download.iter_chunks()
+            self.hash = self.download.hash
+            return
+        sha256 = hashlib.sha256()
+        with open(self.db_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                sha256.update(chunk)
+                yield chunk
+        self.hash = sha256.hexdigest()
+
+    # Хэш источника без разбора (для локального файла — один проход чтения)
+    def calculate_hash(self):
+        for _ in self.iter_chunks():
+            pass
+        return self.hash
+
+    def materials(self):
+        lines = iter_text_lines(self.iter_chunks())
+        if self.db_source == 'txt':
+            return iter_txt_materials(lines)
+        return iter_csv_materials(lines)
@@ -6,21 +6,55 @@ import sqlite3
 import logging
 import json
 import webbrowser
-import pystray
-import requests
-from PIL import Image
-from flask import Flask, request, render_template
-from threading import Thread
+from flask import Flask, Response, request, render_template, redirect
+from markupsafe import Markup, escape
+from threading import Thread, Lock
 import folium
-import hashlib
-import csv
-import io
 import os
+import time
+from functools import lru_cache
+from registry_fetcher import RegistryDownload
+from registry_parser import RegistrySource
+from connection_info import ConnectionInfoCache, IP_INFO_URL, IP_INFO_TTL
+from db_pool import ReadConnectionPool
+from memory_index import MemoryIndex, parse_query
+from vocabulary_filter import load_vocabulary_filter
+from verdict_cache import VerdictCache
+from jobs import JobRunner, JobCancelled, FINAL_STATES
+from scheduler import RefreshScheduler, REFRESH_JITTER, MAX_BACKOFF, parse_window
+from index_builder import apply_material_diff, rebuild_database, rollback_generation, read_meta, GenerationHandle, SCHEMA_VERSION
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
+# Число совпадений на странице результатов (по убыванию релевантности bm25)
+FTS_TOP_K = 20
+# Длина фрагмента текста материала вокруг совпадения (в словах)
+SNIPPET_TOKENS = 24
+# Маркеры совпадений во фрагменте snippet(), после экранирования заменяются на <mark>
+SNIPPET_OPEN = '\x02'
+SNIPPET_CLOSE = '\x03'
+# Максимальное число запросов в одном пакете /api/check
+MAX_BATCH_QUERIES = 50000
+
+# Точность округления координат и число карт в кэше
+MAP_PRECISION = 2
+MAP_CACHE_SIZE = 16
+
 app = Flask(__name__, template_folder='templates')
+connection_info = ConnectionInfoCache()
+db_pool = ReadConnectionPool()
+# Результаты проверки повторяющихся запросов в пределах поколения индекса
+verdict_cache = VerdictCache()
+# Индекс материалов в памяти для движка поиска 'memory' (перестраивается при смене поколения)
+memory_state = {'generation': None, 'index': None}
+memory_lock = Lock()
+# Фильтр Блума по словам корпуса текущего поколения и счётчики отсеянных им запросов
+filter_state = {'generation': None, 'filter': None}
+filter_stats = {'checked': 0, 'rejected': 0}
+filter_lock = Lock()
+# Фоновые задачи пересборки и обновления базы (одновременно выполняется только одна)
+jobs = JobRunner()
 
 def normalize_text(text):
     text = text.lower()
@@ -28,9 +62,6 @@ def normalize_text(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
-def calculate_hash(content):
-    return hashlib.sha256(content.encode('utf-8')).hexdigest()
-
 def load_settings():
     try:
         with open('settings.json', 'r', encoding='utf-8') as f:
@@ -47,16 +78,13 @@ def save_settings(settings):
 
 def check_db_integrity():
     try:
-        conn = sqlite3.connect('./restricted.db')
-        cursor = conn.cursor()
+        cursor = db_pool.connection().cursor()
         cursor.execute('SELECT name FROM sqlite_master WHERE type="table" AND name="restricted_materials"')
         table_exists = cursor.fetchone()
         if not table_exists:
-            conn.close()
             return {'is_valid': False, 'error': 'Таблица restricted_materials отсутствует'}
         cursor.execute('SELECT COUNT(*) FROM restricted_materials')
         count = cursor.fetchone()[0]
-        conn.close()
         if count == 0:
             return {'is_valid': False, 'error': 'База данных пуста'}
         return {'is_valid': True, 'count': count}
@@ -64,81 +92,24 @@ def check_db_integrity():
         logger.error(f"Ошибка проверки целостности базы: {str(e)}")
         return {'is_valid': False, 'error': str(e)}
 
-def init_db():
+def init_db(job=None):
     settings = load_settings()
     db_source = settings.get('db_source', 'txt')
     db_path = settings.get('db_path', './fs_em.txt')
-    materials = []
     
     try:
-        if db_source == 'txt':
-            encodings = ['utf-8', 'windows-1251', 'latin1']
-            content = None
-            for encoding in encodings:
-                try:
-                    with open(db_path, 'r', encoding=encoding) as f:
-                        content = f.read()
-                    logger.info(f"Успешно прочитан файл {db_path} с кодировкой: {encoding}")
-                    break
-                except UnicodeDecodeError:
-                    logger.warning(f"Не удалось прочитать с кодировкой {encoding}, пробуем следующую")
-                    continue
-                except Exception as e:
-                    logger.error(f"Ошибка чтения TXT файла: {str(e)}")
-                    raise
-            if content is None:
-                raise Exception(f"Не удалось прочитать {db_path}: неподдерживаемая кодировка")
-            entries = content.split('Экстремистский материал №')
-            for entry in entries[1:]:
-                match = re.match(r'(\d+): (.+)', entry, re.DOTALL)
-                if match:
-                    material_id = int(match.group(1))
-                    material_text = match.group(2).strip()
-                    date_match = re.search(r'\(решение .+? от ([0-9.]+)\)?', entry)
-                    date = date_match.group(1) if date_match else "Не указана"
-                    materials.append((material_id, date, material_text))
-                else:
-                    logger.warning(f"Не удалось разобрать запись: {entry[:50]}...")
-        elif db_source in ['local_csv', 'remote_csv']:
-            try:
-                if db_source == 'local_csv':
-                    with open(db_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                else:  # remote_csv
-                    logger.warning("SSL verification disabled for remote CSV fetch due to certificate issues")
-                    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-                    response = requests.get(db_path, timeout=5, verify=False, headers=headers)
-                    response.raise_for_status()
-                    content = response.text
-                csv_reader = csv.reader(io.StringIO(content), delimiter=';')
-                header = next(csv_reader, None)  # Считываем заголовок
-                if header and len(header) >= 3 and header[0].strip() == '#' and header[1].strip() == 'Материал' and header[2].strip() == 'Дата включения (указывается с 01.01.2017)':
-                    for row in csv_reader:
-                        if len(row) >= 3 and row[0].strip().isdigit():
-                            material_id = int(row[0].strip())
-                            material_text = row[1].strip() if row[1].strip() else "Не указано"
-                            date = row[2].strip() if row[2].strip() else "Не указана"
-                            materials.append((material_id, date, material_text))
-                        else:
-                            logger.warning(f"Некорректная строка CSV: {row}")
-                else:
-                    logger.error(f"Некорректный заголовок CSV: {header}")
-                    raise ValueError("Некорректный формат CSV")
-            except requests.exceptions.RequestException as e:
-                logger.error(f"Ошибка загрузки удаленного CSV: {str(e)}")
-                raise
-            except Exception as e:
-                logger.error(f"Ошибка чтения CSV: {str(e)}")
-                raise
-        conn = sqlite3.connect('./restricted.db')
-        cursor = conn.cursor()
-        cursor.execute('DROP TABLE IF EXISTS restricted_materials_fts')
-        cursor.execute('CREATE VIRTUAL TABLE restricted_materials_fts USING fts5(id, date, material)')
-        cursor.execute('CREATE TABLE IF NOT EXISTS restricted_materials (id INTEGER PRIMARY KEY, date TEXT, material TEXT)')
-        cursor.execute('DELETE FROM restricted_materials')
-        for material_id, date, material_text in materials:
-            cursor.execute('INSERT INTO restricted_materials (id, date, material) VALUES (?, ?, ?)', (material_id, date, material_text))
-            cursor.execute('INSERT INTO restricted_materials_fts (id, date, material) VALUES (?, ?, ?)', (material_id, date, material_text))
+        # Записи потоком идут из разбора источника в загрузку, новое поколение
+        # строится в теневой базе и подменяет рабочую атомарно
+        source = RegistrySource(db_source, db_path)
+        materials = source.materials()
+        if job is not None:
+            # Запись вставляется сразу после разбора; итог оценивается по текущей базе
+            integrity = check_db_integrity()
+            estimate = integrity['count'] if integrity['is_valid'] else None
+            job.update(stage='loading', total_parsed=estimate, total_inserted=estimate)
+            materials = job.track(materials, 'parsed', 'inserted')
+        count = rebuild_database(materials, source_hash=lambda: source.hash)['count']
+        cursor = db_pool.connection().cursor()
         cursor.execute('SELECT id, material FROM restricted_materials WHERE id = 5467')
         result = cursor.fetchone()
         if result:
@@ -146,69 +117,66 @@ def init_db():
             logger.debug(f"Нормализованный текст ID 5467: {normalize_text(result[1])[:100]}...")
         else:
             logger.warning("ID 5467 НЕ найден в базе")
-        conn.commit()
-        conn.close()
-        logger.info(f"База данных успешно инициализирована, загружено {len(materials)} записей")
-        return {'is_valid': True, 'count': len(materials)}
+        settings['hash'] = source.hash
+        save_settings(settings)
+        logger.info(f"База данных успешно инициализирована, загружено {count} записей")
+        return {'is_valid': True, 'count': count}
+    except JobCancelled:
+        logger.info("Инициализация базы отменена, рабочая база не изменена")
+        raise
     except Exception as e:
         logger.error(f"Ошибка инициализации базы: {str(e)}")
         return {'is_valid': False, 'error': str(e)}
 
-def update_db():
+def update_db(job=None):
     settings = load_settings()
     db_source = settings.get('db_source', 'txt')
     db_path = settings.get('db_path', './fs_em.txt')
     old_hash = settings.get('hash', '')
-    content = None
     try:
-        if db_source == 'txt':
-            with open(db_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        elif db_source == 'local_csv':
-            with open(db_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-        elif db_source == 'remote_csv':
-            logger.warning("SSL verification disabled for remote CSV fetch due to certificate issues")
-            headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
-            response = requests.get(db_path, timeout=5, verify=False, headers=headers)
-            response.raise_for_status()
-            content = response.text
-        new_hash = calculate_hash(content)
+        if db_source == 'remote_csv':
+            # Условный GET: неизменный реестр обходится одним ответом 304, иначе
+            # файл загружается один раз и разбирается во время загрузки
+            download = RegistryDownload(db_path)
+            source = RegistrySource(db_source, db_path, download)
+            new_hash = download.hash if download.not_modified else None
+        else:
+            source = RegistrySource(db_source, db_path)
+            new_hash = source.calculate_hash()
         if new_hash == old_hash:
             integrity = check_db_integrity()
             if not integrity['is_valid']:
                 return {'updated': False, 'new_records': 0, 'error': integrity['error']}
             return {'updated': False, 'new_records': 0}
-        settings['hash'] = new_hash
-        save_settings(settings)
-        conn = sqlite3.connect('./restricted.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM restricted_materials')
-        old_count = cursor.fetchone()[0]
-        conn.close()
-        result = init_db()
-        if not result['is_valid']:
-            return {'updated': False, 'new_records': 0, 'error': result['error']}
+        materials = source.materials()
+        if job is not None:
+            integrity = check_db_integrity()
+            job.update(stage='parsing', total_parsed=integrity['count'] if integrity['is_valid'] else None)
+            materials = job.track(materials, 'parsed')
         conn = sqlite3.connect('./restricted.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM restricted_materials')
-        new_count = cursor.fetchone()[0]
-        conn.close()
-        return {'updated': True, 'new_records': new_count - old_count}
+        try:
+            diff = apply_material_diff(conn, materials, source_hash=lambda: source.hash)
+        finally:
+            conn.close()
+        if job is not None:
+            job.update(inserted=diff['added'] + diff['changed'], removed=diff['removed'])
+        settings['hash'] = source.hash
+        save_settings(settings)
+        if source.hash == old_hash:
+            # Сервер без ETag вернул тот же файл
+            return {'updated': False, 'new_records': 0}
+        return {'updated': True, 'new_records': diff['added'], 'added': diff['added'], 'changed': diff['changed'], 'removed': diff['removed']}
+    except JobCancelled:
+        logger.info("Обновление базы отменено, рабочая база не изменена")
+        raise
     except Exception as e:
         logger.error(f"Ошибка при обновлении базы: {str(e)}")
         return {'updated': False, 'new_records': 0, 'error': str(e)}
 
+# Сведения о подключении берутся из кэша, который обновляется фоновым потоком,
+# так что запрос к внешнему сервису не задерживает ответ страницы
 def get_public_ip_info():
-    try:
-        response = requests.get('http://ip-api.com/json/', timeout=5)
-        data = response.json()
-        if data['status'] == 'success':
-            return {'ip': data['query'], 'country': data['country'], 'lat': data.get('lat', 0.0), 'lon': data.get('lon', 0.0)}
-        return {'ip': 'Не удалось определить', 'country': 'Не удалось определить', 'lat': 0.0, 'lon': 0.0}
-    except Exception as e:
-        logger.error(f"Ошибка получения IP: {str(e)}")
-        return {'ip': 'Ошибка', 'country': 'Ошибка', 'lat': 0.0, 'lon': 0.0}
+    return connection_info.get()
 
 def load_tiles():
     try:
@@ -227,15 +195,29 @@ def save_tiles(tiles):
     except Exception as e:
         logger.error(f"Ошибка сохранения tiles.json: {str(e)}")
 
+# Карта строится заново только для новых координат: готовый HTML кэшируется по координатам,
+# округлённым до MAP_PRECISION знаков (около километра), не больше MAP_CACHE_SIZE вариантов
+@lru_cache(maxsize=MAP_CACHE_SIZE)
+def _render_map(lat, lon):
+    start = time.perf_counter()
+    m = folium.Map(location=[lat, lon], zoom_start=10, width='100%', height='400px')
+    folium.Marker([lat, lon], popup='Примерное местоположение').add_to(m)
+    map_html = m._repr_html_()
+    logger.info(f"Карта для ({lat}, {lon}) построена за {time.perf_counter() - start:.2f} с")
+    return map_html
+
 def generate_map(lat, lon):
     try:
-        m = folium.Map(location=[lat, lon], zoom_start=10, width='100%', height='400px')
-        folium.Marker([lat, lon], popup='Примерное местоположение').add_to(m)
-        return m._repr_html_()
+        return _render_map(round(float(lat), MAP_PRECISION), round(float(lon), MAP_PRECISION))
     except Exception as e:
         logger.error(f"Ошибка генерации карты: {str(e)}")
         return "<p>Ошибка загрузки карты</p>"
 
+# Соединение чтения потока возвращается в пул по окончании каждого запроса
+@app.teardown_request
+def release_db_connection(exc):
+    db_pool.release()
+
 @app.route('/', methods=['GET', 'POST'])
 def index():
     ip_info = get_public_ip_info()
@@ -274,34 +256,318 @@ def index():
         query = normalize_text(request.form.get('query', ''))
         if query:
             logger.info(f"Получен запрос: {query}")
-            conn = sqlite3.connect('./restricted.db')
-            cursor = conn.cursor()
-            cursor.execute('SELECT id, date, material FROM restricted_materials_fts WHERE material MATCH ?', (query,))
-            matches = cursor.fetchall()
-            conn.close()
-            if matches:
-                logger.warning(f"Найдено {len(matches)} запрещённых материалов для запроса '{query}'")
-                return render_template('index.html', warning=matches, query=query, ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
+            page = parse_page(request.form.get('page'))
+            backend = settings.get('search_backend', 'fts')
+            if backend == 'memory':
+                engine, generation = get_memory_index()
+            else:
+                generation = db_pool.generation()
+            result = verdict_cache.get(generation, (backend, query, page))
+            if result is None:
+                if backend == 'memory':
+                    result = find_matches_in_memory(engine, query, page)
+                elif is_outside_vocabulary(get_vocabulary_filter(), query):
+                    result = {'total': 0, 'page': 0, 'matches': []}
+                else:
+                    with GenerationHandle(conn=db_pool.connection()) as handle:
+                        result = find_matches(handle, query, page)
+                    generation = handle.generation
+                verdict_cache.put(generation, (backend, query, page), result)
+            if result['total']:
+                logger.warning(f"Найдено {result['total']} запрещённых материалов для запроса '{query}'")
+                return render_template('index.html', warning=result['matches'], warning_total=result['total'], page=result['page'],
+                                       page_size=FTS_TOP_K, page_count=-(-result['total'] // FTS_TOP_K), query=query, ip_info=ip_info,
+                                       tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
             logger.info(f"Запрос '{query}' безопасен")
             return render_template('index.html', safe_query=query, ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
         return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
     return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
 
+# Эмбеддинги нового поколения для app.py строятся в той же задаче, если включён build_embeddings
+def build_embeddings(job):
+    from embedding_builder import build_embedding_store
+
+    def progress(done, total):
+        job.check_cancelled()
+        job.update(stage='embedding', embedded=done, total_embedded=total)
+
+    job.update(stage='embedding')
+    return build_embedding_store('./restricted.db', progress=progress)
+
+# Задача полной пересборки базы из источника в settings.json
+def rebuild_job(job):
+    result = init_db(job)
+    if not result['is_valid']:
+        raise RuntimeError(result['error'])
+    job.update(stage='indexed', inserted=result['count'])
+    if load_settings().get('build_embeddings'):
+        build_embeddings(job)
+    return result
+
+# Задача обновления базы по хэшу источника
+def update_job(job):
+    job.update(stage='checking')
+    result = update_db(job)
+    if result.get('error'):
+        raise RuntimeError(result['error'])
+    if result['updated'] and load_settings().get('build_embeddings'):
+        build_embeddings(job)
+    return result
+
+# Задача отката к предыдущему поколению. Выполняется как задача базы, чтобы не пересекаться
+# с обновлением или пересборкой (их итоговая запись хэша отменила бы сброс хэша при откате)
+def rollback_job(job):
+    job.update(stage='rollback')
+    result = rollback_generation()
+    if not result['rolled_back']:
+        raise RuntimeError(result['error'])
+    # Хэш сброшен и в базе, поэтому следующее обновление (в том числе плановое) снова применит реестр
+    settings = load_settings()
+    settings['hash'] = ''
+    save_settings(settings)
+    return result
+
+# Плановое обновление: задача update через общий механизм задач. None, если уже идёт
+# другая задача базы (планировщик повторит позже)
+def scheduled_update():
+    job, created = jobs.submit('update', update_job, key='database')
+    if not created:
+        return None
+    while job['state'] not in FINAL_STATES:
+        time.sleep(1)
+        job = jobs.get(job['id'])
+    if job['state'] != 'done':
+        raise RuntimeError(job['error'] or 'Задача обновления отменена')
+    return job['result']
+
+# Периодическое обновление реестра (включается ключом refresh_interval в settings.json)
+scheduler = RefreshScheduler(scheduled_update)
+
+def start_scheduler():
+    settings = load_settings()
+    if not settings.get('refresh_interval'):
+        return False
+    scheduler.interval = settings['refresh_interval']
+    scheduler.jitter = settings.get('refresh_jitter', REFRESH_JITTER)
+    scheduler.max_backoff = settings.get('refresh_max_backoff', MAX_BACKOFF)
+    try:
+        scheduler.window = parse_window(settings.get('refresh_window'))
+    except ValueError as e:
+        logger.error(f"{str(e)}, плановое обновление выполняется без окна")
+        scheduler.window = None
+    scheduler.start()
+    return True
+
+# Запрос от скрипта страницы (fetch с Accept: application/json), а не отправка формы
+def wants_json():
+    return request.accept_mimetypes.accept_json and not request.accept_mimetypes.accept_html
+
+# Ответ на запуск задачи: JSON для скрипта страницы, для формы — переход на главную с отслеживанием задачи
+def job_response(job, created):
+    if wants_json():
+        return json.dumps(dict(job, deduplicated=not created), ensure_ascii=False), 202 if created else 200, {'Content-Type': 'application/json'}
+    return redirect(f"/?job={job['id']}")
+
+# Задача текущая или запрошенная страницей (?job=...) — для индикатора прогресса на любой странице
+@app.context_processor
+def inject_job():
+    return {'job': jobs.get(request.args.get('job')) or jobs.active('database')}
+
 @app.route('/update-db', methods=['POST'])
 def update_db_route():
-    update_info = update_db()
-    ip_info = get_public_ip_info()
-    tiles = load_tiles()
-    settings = load_settings()
-    db_status = check_db_integrity()
-    map_html = generate_map(ip_info['lat'], ip_info['lon']) if ip_info['lat'] and ip_info['lon'] else "<p>Нет данных для карты</p>"
-    show_init_modal = db_status['is_valid'] is False
-    if update_info.get('error'):
-        return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, error=f"Ошибка обновления базы: {update_info['error']}", settings=settings, show_init_modal=show_init_modal)
-    return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
+    return job_response(*jobs.submit('update', update_job, key='database'))
+
+@app.route('/rollback-db', methods=['POST'])
+def rollback_db_route():
+    return job_response(*jobs.submit('rollback', rollback_job, key='database'))
+
+def parse_page(value):
+    try:
+        return max(int(value or 0), 0)
+    except ValueError:
+        return 0
+
+# Фрагмент snippet() в HTML: текст экранируется, маркеры совпадений становятся <mark>
+def highlight_snippet(snippet):
+    return Markup(str(escape(snippet)).replace(SNIPPET_OPEN, '<mark>').replace(SNIPPET_CLOSE, '</mark>'))
+
+# Поиск совпадений для нормализованного запроса в рамках открытого поколения индекса:
+# общее число совпадений и одна страница из FTS_TOP_K лучших по bm25 с фрагментами текста
+def find_matches(handle, query, page=0):
+    cursor = handle.cursor()
+    cursor.execute('SELECT COUNT(*) FROM restricted_materials_fts WHERE material MATCH ?', (query,))
+    total = cursor.fetchone()[0]
+    if not total:
+        return {'total': 0, 'page': 0, 'matches': []}
+    page = min(page, (total - 1) // FTS_TOP_K)
+    cursor.execute('SELECT id, date, snippet(restricted_materials_fts, 2, ?, ?, \'…\', ?) FROM restricted_materials_fts '
+                   'WHERE material MATCH ? ORDER BY rank LIMIT ? OFFSET ?',
+                   (SNIPPET_OPEN, SNIPPET_CLOSE, SNIPPET_TOKENS, query, FTS_TOP_K, page * FTS_TOP_K))
+    matches = [(material_id, date, highlight_snippet(snippet)) for material_id, date, snippet in cursor.fetchall()]
+    return {'total': total, 'page': page, 'matches': matches}
+
+# Облегчённый поиск для пакетной проверки: только id FTS_TOP_K лучших по bm25 и общее число
+# совпадений одним запросом, без фрагментов текста и отдельного COUNT
+def find_match_ids(handle, query):
+    cursor = handle.cursor()
+    cursor.execute('SELECT rowid, COUNT(*) OVER () FROM restricted_materials_fts WHERE material MATCH ? ORDER BY rank LIMIT ?',
+                   (query, FTS_TOP_K))
+    rows = cursor.fetchall()
+    return {'total': rows[0][1] if rows else 0, 'ids': [material_id for material_id, _ in rows]}
+
+# Индекс в памяти для текущего поколения базы (строится при первом обращении и после смены поколения)
+def get_memory_index():
+    with memory_lock:
+        if memory_state['generation'] != db_pool.generation():
+            with GenerationHandle(conn=db_pool.connection()) as handle:
+                memory_state['index'] = MemoryIndex.from_cursor(handle.cursor())
+                memory_state['generation'] = handle.generation
+        return memory_state['index'], memory_state['generation']
+
+# Фильтр словаря для текущего поколения базы (None, если база построена без него)
+def get_vocabulary_filter():
+    generation = db_pool.generation()
+    with filter_lock:
+        if filter_state['generation'] != generation:
+            filter_state['filter'] = load_vocabulary_filter(db_pool.connection())
+            filter_state['generation'] = generation
+        return filter_state['filter']
+
+# FTS5 соединяет слова запроса через AND, поэтому запрос заведомо безопасен,
+# если хотя бы одного его слова точно нет в корпусе
+def is_outside_vocabulary(vocabulary_filter, query):
+    if vocabulary_filter is None:
+        return False
+    try:
+        phrases = parse_query(query)
+    except ValueError:
+        return False
+    filter_stats['checked'] += 1
+    if any(not vocabulary_filter.might_contain(token) for phrase in phrases for token in phrase):
+        filter_stats['rejected'] += 1
+        return True
+    return False
+
+# То же, что find_matches, но по индексу в памяти, без обращений к базе
+def find_matches_in_memory(engine, query, page=0):
+    phrases = parse_query(query)
+    docs = engine.search(phrases)
+    total = len(docs)
+    if not total:
+        return {'total': 0, 'page': 0, 'matches': []}
+    page = min(page, (total - 1) // FTS_TOP_K)
+    matches = [(int(engine.ids[doc]), engine.dates[doc],
+                highlight_snippet(engine.snippet(doc, phrases, SNIPPET_OPEN, SNIPPET_CLOSE, tokens=SNIPPET_TOKENS)))
+               for doc in docs[page * FTS_TOP_K:(page + 1) * FTS_TOP_K].tolist()]
+    return {'total': total, 'page': page, 'matches': matches}
+
+# То же, что find_match_ids, но по индексу в памяти
+def find_match_ids_in_memory(engine, query):
+    docs = engine.search(parse_query(query))
+    return {'total': len(docs), 'ids': [int(material_id) for material_id in engine.ids[docs[:FTS_TOP_K]].tolist()]}
+
+# Разбор тела пакетного запроса: JSON-список, {"queries": [...]} или текст по запросу в строке
+def parse_batch_queries():
+    if request.is_json:
+        payload = request.get_json(silent=True)
+        queries = payload.get('queries') if isinstance(payload, dict) else payload
+        if not isinstance(queries, list):
+            return None
+        return [str(query) for query in queries]
+    return request.get_data(as_text=True).splitlines()
+
+# Пакетная проверка запросов: одно соединение и одно поколение индекса на весь пакет,
+# одинаковые после нормализации запросы проверяются один раз, ответ отдаётся потоком NDJSON
+@app.route('/api/check', methods=['POST'])
+def api_check():
+    queries = parse_batch_queries()
+    if queries is None:
+        return json.dumps({'error': 'Ожидается список запросов или {"queries": [...]}'}, ensure_ascii=False), 400, {'Content-Type': 'application/json'}
+    if len(queries) > MAX_BATCH_QUERIES:
+        return json.dumps({'error': f'Не больше {MAX_BATCH_QUERIES} запросов в пакете'}, ensure_ascii=False), 413, {'Content-Type': 'application/json'}
+
+    backend = load_settings().get('search_backend', 'fts')
+    engine, generation = get_memory_index() if backend == 'memory' else (None, None)
+    vocabulary_filter = get_vocabulary_filter() if engine is None else None
+
+    def generate():
+        start = time.perf_counter()
+        results = {}
+        counts = {'safe': 0, 'restricted': 0, 'empty': 0, 'error': 0}
+        # Движку FTS5 нужно одно соединение на весь пакет, индексу в памяти — ни одного
+        handle = GenerationHandle() if engine is None else None
+        current = handle.generation if handle is not None else generation
+        try:
+            for query in queries:
+                normalized = normalize_text(query)
+                result = results.get(normalized)
+                if result is None:
+                    if not normalized:
+                        result = {'verdict': 'empty', 'total': 0, 'ids': []}
+                    else:
+                        try:
+                            # Отдельный ключ кэша: в записях страницы (backend, запрос, номер страницы) хранятся фрагменты
+                            found = verdict_cache.get(current, (backend, normalized, 'ids'))
+                            if found is None:
+                                if engine is not None:
+                                    found = find_match_ids_in_memory(engine, normalized)
+                                elif is_outside_vocabulary(vocabulary_filter, normalized):
+                                    found = {'total': 0, 'ids': []}
+                                else:
+                                    found = find_match_ids(handle, normalized)
+                                verdict_cache.put(current, (backend, normalized, 'ids'), found)
+                            result = {'verdict': 'restricted' if found['total'] else 'safe', 'total': found['total'],
+                                      'ids': [int(material_id) for material_id in found['ids']]}
+                        except (sqlite3.Error, ValueError) as e:
+                            result = {'verdict': 'error', 'total': 0, 'ids': [], 'error': str(e)}
+                    results[normalized] = result
+                counts[result['verdict']] += 1
+                yield json.dumps(dict(result, query=query, normalized=normalized), ensure_ascii=False) + '\n'
+        finally:
+            if handle is not None:
+                handle.close()
+        elapsed = time.perf_counter() - start
+        logger.info(f"Пакетная проверка: {len(queries)} запросов ({len(results)} уникальных) за {elapsed:.2f} с, "
+                    f"найдено совпадений: {counts['restricted']}")
+        yield json.dumps({'summary': dict(counts, total=len(queries), unique=len(results), backend=backend,
+                                          generation=current, elapsed=round(elapsed, 3))}, ensure_ascii=False) + '\n'
+
+    return Response(generate(), mimetype='application/x-ndjson')
+
+# Полный текст материала (открывается по запросу из окна с фрагментом)
+@app.route('/material/<int:material_id>', methods=['GET'])
+def material(material_id):
+    cursor = db_pool.connection().cursor()
+    cursor.execute('SELECT id, date, material FROM restricted_materials WHERE id = ?', (material_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return json.dumps({'error': 'Материал не найден'}, ensure_ascii=False), 404, {'Content-Type': 'application/json'}
+    return json.dumps({'id': row[0], 'date': row[1], 'material': row[2]}, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+@app.route('/cache-stats', methods=['GET'])
+def cache_stats():
+    stats = verdict_cache.info()
+    vocabulary_filter = get_vocabulary_filter()
+    if vocabulary_filter is not None:
+        measured = read_meta(db_pool.connection()).get('filter_fp_rate')
+        stats['vocabulary_filter'] = dict(vocabulary_filter.info(), **filter_stats, generation=filter_state['generation'],
+                                          measured_fp_rate=float(measured) if measured else None)
+    return json.dumps(stats, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+@app.route('/connection-info', methods=['GET'])
+def connection_info_route():
+    return json.dumps(connection_info.get(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+@app.route('/refresh-connection-info', methods=['POST'])
+def refresh_connection_info():
+    return json.dumps(connection_info.refresh(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
 
 @app.route('/init-database', methods=['POST'])
 def init_database():
+    # Пока идёт пересборка или обновление, настройки источника не меняются
+    active = jobs.active('database')
+    if active:
+        return job_response(active, False)
     settings = load_settings()
     settings['db_source'] = request.form.get('db_source', 'txt')
     if settings['db_source'] == 'local_csv':
@@ -310,18 +576,13 @@ def init_database():
         settings['db_path'] = './fs_em.txt' if settings['db_source'] == 'txt' else 'https://www.minjust.gov.ru/uploaded/files/exportfsm.csv'
     settings['hash'] = ''
     save_settings(settings)
-    result = init_db()
-    ip_info = get_public_ip_info()
-    tiles = load_tiles()
-    db_status = check_db_integrity()
-    map_html = generate_map(ip_info['lat'], ip_info['lon']) if ip_info['lat'] and ip_info['lon'] else "<p>Нет данных для карты</p>"
-    show_init_modal = db_status['is_valid'] is False
-    if not result['is_valid']:
-        return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, error=f"Ошибка инициализации базы: {result['error']}", settings=settings, show_init_modal=show_init_modal)
-    return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, settings=settings, show_init_modal=show_init_modal)
+    return job_response(*jobs.submit('rebuild', rebuild_job, key='database'))
 
 @app.route('/update-settings', methods=['POST'])
 def update_settings():
+    active = jobs.active('database')
+    if active:
+        return job_response(active, False)
     settings = load_settings()
     settings['db_source'] = request.form.get('db_source', 'txt')
     if settings['db_source'] == 'local_csv':
@@ -330,16 +591,54 @@ def update_settings():
         settings['db_path'] = './fs_em.txt' if settings['db_source'] == 'txt' else 'https://www.minjust.gov.ru/uploaded/files/exportfsm.csv'
     settings['hash'] = ''
     save_settings(settings)
-    result = init_db()
-    update_info = {'updated': True, 'new_records': result['count']} if result['is_valid'] else {'updated': False, 'new_records': 0}
-    ip_info = get_public_ip_info()
-    tiles = load_tiles()
-    db_status = check_db_integrity()
-    map_html = generate_map(ip_info['lat'], ip_info['lon']) if ip_info['lat'] and ip_info['lon'] else "<p>Нет данных для карты</p>"
-    show_init_modal = db_status['is_valid'] is False
-    if not result['is_valid']:
-        return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, error=f"Ошибка инициализации базы: {result['error']}", settings=settings, show_init_modal=show_init_modal, update_info=update_info)
-    return render_template('index.html', ip_info=ip_info, tiles=tiles, map_html=map_html, update_info=update_info, settings=settings, show_init_modal=show_init_modal)
+    return job_response(*jobs.submit('rebuild', rebuild_job, key='database'))
+
+# Список задач (последние JOBS_HISTORY)
+@app.route('/jobs', methods=['GET'])
+def jobs_list():
+    return json.dumps(jobs.list(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        return json.dumps({'error': 'Задача не найдена'}, ensure_ascii=False), 404, {'Content-Type': 'application/json'}
+    return json.dumps(job, ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+# Прогресс задачи через Server-Sent Events: снимок состояния при каждом изменении до завершения задачи
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    if jobs.get(job_id) is None:
+        return json.dumps({'error': 'Задача не найдена'}, ensure_ascii=False), 404, {'Content-Type': 'application/json'}
+
+    def generate():
+        for snapshot in jobs.events(job_id):
+            if snapshot is None:
+                yield ': keep-alive\n\n'
+            else:
+                yield f"id: {snapshot['version']}\ndata: {json.dumps(snapshot, ensure_ascii=False)}\n\n"
+
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Состояние планового обновления: следующий запуск, последний запуск, последнее изменение, длительность
+@app.route('/scheduler-status', methods=['GET'])
+def scheduler_status():
+    return json.dumps(scheduler.status(), ensure_ascii=False), 200, {'Content-Type': 'application/json'}
+
+# Внеочередной запуск планового обновления
+@app.route('/scheduler-run', methods=['POST'])
+def scheduler_run():
+    status = scheduler.status()
+    if not status['enabled']:
+        return json.dumps({'triggered': False, 'error': 'Плановое обновление выключено'}, ensure_ascii=False), 409, {'Content-Type': 'application/json'}
+    scheduler.trigger()
+    return json.dumps({'triggered': True}, ensure_ascii=False), 202, {'Content-Type': 'application/json'}
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def job_cancel(job_id):
+    if not jobs.cancel(job_id):
+        return json.dumps({'cancelled': False, 'error': 'Задача не найдена или уже завершена'}, ensure_ascii=False), 409, {'Content-Type': 'application/json'}
+    return json.dumps({'cancelled': True}, ensure_ascii=False), 202, {'Content-Type': 'application/json'}
 
 @app.route('/export-tiles', methods=['GET'])
 def export_tiles():
@@ -360,7 +659,11 @@ def import_tiles():
 def clear_history():
     return '', 200
 
+# pystray и PIL импортируются только для значка в трее: на сервере без графического окружения
+# (serve.py) импорт pystray завершается ошибкой подключения к X-серверу
 def create_tray():
+    import pystray
+    from PIL import Image
     try:
         icon = Image.open("icon.png")
     except FileNotFoundError:
@@ -373,14 +676,49 @@ def create_tray():
     tray = pystray.Icon("Berkut Search", icon, "Berkut Search", menu)
     return tray
 
+# Время ожидания отмены фоновых задач при выходе (в секундах)
+SHUTDOWN_TIMEOUT = 30
+
 def stop_app():
     tray.stop()
+    jobs.shutdown(SHUTDOWN_TIMEOUT)
     import os
     os._exit(0)
 
+# Проверка базы при запуске: пересборка только если база не соответствует
+# сохранённому хэшу источника или версии схемы индекса
+def ensure_db():
+    settings = load_settings()
+    integrity = check_db_integrity()
+    if integrity['is_valid']:
+        meta = read_meta(db_pool.connection())
+        source_hash = settings.get('hash')
+        db_source = settings.get('db_source', 'txt')
+        if db_source != 'remote_csv':
+            # Локальный файл хэшируется заново (один проход чтения без разбора): его могли заменить,
+            # пока приложение не работало. Удалённый реестр сверяется с сохранённым хэшем без загрузки
+            try:
+                source_hash = RegistrySource(db_source, settings.get('db_path', './fs_em.txt')).calculate_hash()
+            except Exception as e:
+                logger.error(f"Ошибка чтения источника базы: {str(e)}")
+                return integrity
+        if source_hash and meta.get('source_hash') == source_hash and meta.get('schema_version') == str(SCHEMA_VERSION):
+            logger.info(f"База данных актуальна (поколение {meta.get('generation')}, {integrity['count']} записей), пересборка не требуется")
+            return integrity
+        logger.info("База данных не соответствует источнику или версии схемы, выполняется пересборка")
+    return init_db()
+
 def run_flask():
-    init_db()
-    app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False)
+    settings = load_settings()
+    connection_info.url = settings.get('ip_info_url', IP_INFO_URL)
+    connection_info.ttl = settings.get('ip_info_ttl', IP_INFO_TTL)
+    # Первое получение сведений о подключении идёт в фоне, пока проверяется база
+    connection_info.get()
+    ensure_db()
+    if settings.get('search_backend') == 'memory':
+        get_memory_index()
+    start_scheduler()
+    app.run(host='127.0.0.1', port=5000, debug=False, use_reloader=False, threaded=True)
 
 if __name__ == '__main__':
     tray = create_tray()
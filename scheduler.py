@@ -0,0 +1,207 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+from file_lock import FileLock
+
+logger = logging.getLogger(__name__)
+
+# Файл состояния планировщика (общий для всех процессов приложения и сохраняется между запусками)
+SCHEDULER_STATE_FILE = './scheduler_state.json'
+# Интервал обновления реестра по умолчанию (в секундах)
+REFRESH_INTERVAL = 6 * 3600
+# Случайное отклонение от интервала (доля интервала), чтобы узлы не обращались к источнику одновременно
+REFRESH_JITTER = 0.1
+# Первая повторная попытка после ошибки и верхняя граница экспоненциальной задержки (в секундах)
+RETRY_DELAY = 60
+MAX_BACKOFF = 6 * 3600
+# Пауза, если в момент запуска уже выполняется другая задача базы (в секундах)
+BUSY_DELAY = 60
+# Как часто поток перечитывает состояние, пока ждёт запуска (в секундах)
+POLL_INTERVAL = 60
+
+def _format_time(timestamp):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) if timestamp else None
+
+# Окно запуска 'ЧЧ:ММ-ЧЧ:ММ' по местному времени (может переходить через полночь) в минутах от начала суток
+def parse_window(window):
+    if not window:
+        return None
+    try:
+        start, end = window.split('-')
+        start_hours, start_minutes = map(int, start.strip().split(':'))
+        end_hours, end_minutes = map(int, end.strip().split(':'))
+    except ValueError:
+        raise ValueError(f"Неверное окно обновления: {window} (ожидается ЧЧ:ММ-ЧЧ:ММ)")
+    return start_hours * 60 + start_minutes, end_hours * 60 + end_minutes
+
+# Перенос момента запуска в ближайшее окно (случайная точка внутри окна); момент внутри окна не меняется
+def align_to_window(timestamp, window, rng=random):
+    if window is None:
+        return timestamp
+    start, end = window
+    length = (end - start) % (24 * 60) or 24 * 60
+    local = time.localtime(timestamp)
+    minute = local.tm_hour * 60 + local.tm_min
+    if (minute - start) % (24 * 60) < length:
+        return timestamp
+    midnight = time.mktime((local.tm_year, local.tm_mon, local.tm_mday, 0, 0, 0, 0, 0, -1))
+    opening = midnight + start * 60
+    if opening <= timestamp:
+        opening = time.mktime((local.tm_year, local.tm_mon, local.tm_mday + 1, 0, 0, 0, 0, 0, -1)) + start * 60
+    return opening + rng.uniform(0, length * 60)
+
+# Периодический запуск обновления реестра: интервал со случайным отклонением, экспоненциальная
+# задержка после ошибок и, при необходимости, перенос в окно низкой нагрузки.
+# run_once() возвращает результат update_db, None если запуск пропущен (уже идёт другая задача базы),
+# или выбрасывает исключение при ошибке. Момент следующего запуска хранится в файле состояния,
+# а проверка и запуск выполняются под блокировкой этого файла, поэтому из нескольких процессов
+# (обработчики serve.py) обновление запускает только один
+class RefreshScheduler:
+    def __init__(self, run_once, interval=REFRESH_INTERVAL, jitter=REFRESH_JITTER, window=None,
+                 retry_delay=RETRY_DELAY, max_backoff=MAX_BACKOFF, state_file=SCHEDULER_STATE_FILE):
+        self.run_once = run_once
+        self.interval = interval
+        self.jitter = jitter
+        self.window = parse_window(window)
+        self.retry_delay = retry_delay
+        self.max_backoff = max_backoff
+        self.state_file = state_file
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = FileLock(state_file + '.lock')
+
+    def load_state(self):
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logger.warning(f"Не удалось прочитать состояние планировщика: {str(e)}")
+            return {}
+
+    def _save_state(self, state):
+        tmp_path = f"{self.state_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.state_file)
+
+    # Задержка до следующего запуска: интервал после успеха, экспоненциальная — после ошибок подряд
+    def next_delay(self, failures):
+        if failures:
+            delay = min(self.max_backoff, self.retry_delay * 2 ** (failures - 1))
+        else:
+            delay = self.interval
+        return delay * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def _schedule(self, state, now):
+        next_run = now + self.next_delay(state.get('failures', 0))
+        # Повторы после ошибок не ждут окна, плановые запуски переносятся в него
+        state['next_run'] = next_run if state.get('failures') else align_to_window(next_run, self.window)
+        return state
+
+    # Запуск обновления. None, если запуск сейчас выполняет другой процесс или поток, если без force
+    # срок ещё не наступил (запуск уже выполнил другой процесс) или если занята база
+    def run_now(self, force=False):
+        if not self._lock.acquire(blocking=False):
+            logger.debug("Плановое обновление уже выполняется другим процессом")
+            return None
+        try:
+            # Состояние читается только под блокировкой: между проверкой срока и записью
+            # следующего запуска другой процесс не может начать то же обновление
+            state = self.load_state()
+            started = time.time()
+            if not force and state.get('next_run', 0) > started:
+                return None
+            state['last_run'] = started
+            try:
+                result = self.run_once()
+            except Exception as e:
+                state['failures'] = state.get('failures', 0) + 1
+                state['last_status'] = 'failed'
+                state['last_error'] = str(e)
+                logger.error(f"Плановое обновление реестра завершилось ошибкой (подряд: {state['failures']}): {str(e)}")
+            else:
+                if result is None:
+                    logger.info("Плановое обновление отложено: уже выполняется задача базы")
+                    return None
+                state['failures'] = 0
+                state['last_status'] = 'changed' if result.get('updated') else 'unchanged'
+                state['last_error'] = None
+                state['last_success'] = time.time()
+                state['last_result'] = result
+                if result.get('updated'):
+                    state['last_change'] = state['last_success']
+            finished = time.time()
+            state['last_duration'] = round(finished - started, 3)
+            state['runs'] = state.get('runs', 0) + 1
+            self._schedule(state, finished)
+            self._save_state(state)
+            logger.info(f"Следующее плановое обновление реестра: {_format_time(state['next_run'])}")
+            return state
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        with FileLock(self.state_file + '.lock'):
+            state = self.load_state()
+            if not state.get('next_run'):
+                # Первый запуск планировщика: проверка базы уже выполнена при старте приложения
+                self._save_state(self._schedule(state, time.time()))
+        while not self._stop.is_set():
+            next_run = self.load_state().get('next_run') or time.time()
+            delay = next_run - time.time()
+            forced = False
+            if delay > 0:
+                # Состояние перечитывается периодически: запуск мог выполнить другой процесс
+                self._wake.wait(min(delay, POLL_INTERVAL))
+                if not self._wake.is_set():
+                    continue
+                self._wake.clear()
+                if self._stop.is_set():
+                    return
+                forced = True
+            if self.run_now(forced) is None:
+                self._wake.wait(BUSY_DELAY)
+                self._wake.clear()
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='refresh-scheduler', daemon=True)
+            self._thread.start()
+            next_run = self.load_state().get('next_run')
+            logger.info(f"Плановое обновление реестра каждые {self.interval} с (±{self.jitter:.0%})"
+                        f"{', следующее: ' + _format_time(next_run) if next_run else ''}")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    # Ожидание выхода потока после stop(): идущий запуск успевает записать состояние
+    def join(self, timeout=None):
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+
+    # Немедленный запуск из фонового потока (например, по запросу администратора)
+    def trigger(self):
+        self._wake.set()
+
+    def status(self):
+        state = self.load_state()
+        now = time.time()
+        info = dict(state)
+        for name in ('next_run', 'last_run', 'last_success', 'last_change'):
+            info[name] = _format_time(state.get(name))
+        info['enabled'] = self._thread is not None and self._thread.is_alive()
+        info['interval'] = self.interval
+        info['seconds_to_next_run'] = round(max(0.0, state['next_run'] - now), 1) if state.get('next_run') else None
+        info['seconds_since_change'] = round(now - state['last_change'], 1) if state.get('last_change') else None
+        return info
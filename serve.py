@@ -0,0 +1,280 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import os
+import gc
+import sys
+import time
+import socket
+import signal
+import sqlite3
+import logging
+import argparse
+import threading
+from werkzeug.serving import ThreadedWSGIServer, WSGIRequestHandler
+import run
+from index_builder import DB_PATH, read_generation
+
+logger = logging.getLogger(__name__)
+
+# Число процессов-обработчиков и одновременных запросов в каждом из них
+SERVE_WORKERS = 4
+SERVE_THREADS = 8
+# Интервал проверки поколения базы главным процессом (в секундах)
+RELOAD_INTERVAL = 5
+# Сколько ждать завершения текущих запросов при остановке обработчика (в секундах)
+GRACEFUL_TIMEOUT = 30
+# Сигнал замены обработчика при перезагрузке: обработчик перестаёт принимать подключения, но завершается
+# только после своих задач базы (по SIGTERM, при остановке сервера, задачи отменяются)
+RETIRE_SIGNAL = getattr(signal, 'SIGUSR1', None)
+LISTEN_BACKLOG = 128
+
+# Соединение закрывается после ответа: простаивающий keep-alive клиент не занимает поток обработчика
+class RequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+# Сервер обработчика на общем слушающем сокете (fd) или на своём (fd=None, режим одного процесса):
+# не больше threads запросов одновременно, при остановке дожидается завершения уже принятых запросов
+class WorkerServer(ThreadedWSGIServer):
+    daemon_threads = False
+    block_on_close = True
+
+    def __init__(self, host, port, app, fd, threads):
+        super().__init__(host, port, app, handler=RequestHandler, fd=fd)
+        if fd is not None:
+            # Несколько процессов ждут подключений на одном сокете: проигравший accept() не блокируется
+            self.socket.setblocking(False)
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            super().process_request(request, client_address)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def process_request_thread(self, request, client_address):
+        try:
+            super().process_request_thread(request, client_address)
+        finally:
+            self._slots.release()
+
+# Загрузка общего состояния в главном процессе до запуска обработчиков: база, фильтр словаря
+# и индекс в памяти. Обработчики получают их при fork() и делят страницы памяти, пока не изменят их.
+# При перезагрузке (check_db=False) база не проверяется: новое поколение уже построено обновлением или откатом
+def preload(check_db=True):
+    gc.unfreeze()
+    settings = run.load_settings()
+    run.connection_info.url = settings.get('ip_info_url', run.IP_INFO_URL)
+    run.connection_info.ttl = settings.get('ip_info_ttl', run.IP_INFO_TTL)
+    if check_db:
+        run.ensure_db()
+    generation = run.db_pool.generation()
+    run.get_vocabulary_filter()
+    if settings.get('search_backend') == 'memory':
+        run.get_memory_index()
+    # Соединения SQLite нельзя передавать через fork(): каждый обработчик откроет свои
+    run.db_pool.close()
+    run.verdict_cache.clear()
+    # Объекты, созданные до fork(), исключаются из сборки мусора, чтобы её проходы не копировали их страницы
+    gc.collect()
+    gc.freeze()
+    return generation
+
+def current_generation():
+    conn = sqlite3.connect(DB_PATH)
+    try:
+        return read_generation(conn)
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+
+def _serve_worker(listener, host, port, threads):
+    server = WorkerServer(host, port, run.app, listener.fileno(), threads)
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        if signum == signal.SIGTERM:
+            # Задачи базы отменяются сразу: иначе server_close() ждал бы потоки SSE, следящие за ними
+            run.jobs.cancel_all()
+        if not stopping.is_set():
+            stopping.set()
+            # shutdown() ждёт выхода из serve_forever(), поэтому вызывается из отдельного потока
+            threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(RETIRE_SIGNAL, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    logger.info(f"Обработчик {os.getpid()} запущен, одновременных запросов: {threads}")
+    # Потоки не переживают fork(), поэтому планировщик запускается в каждом обработчике;
+    # момент запуска общий (файл состояния), обновление выполняет один из них
+    run.start_scheduler()
+    server.serve_forever()
+    # Ожидание завершения принятых запросов, затем задач базы этого обработчика: при перезагрузке
+    # они дорабатывают (задача, сменившая поколение базы, могла ещё не закончиться), при остановке уже отменены
+    server.server_close()
+    run.scheduler.stop()
+    running = run.jobs.active('database')
+    if running is not None and running['pid'] == os.getpid():
+        logger.info(f"Обработчик {os.getpid()} ожидает завершения задачи {running['id']} ({running['kind']})")
+    run.jobs.join()
+    run.scheduler.join(GRACEFUL_TIMEOUT)
+    logger.info(f"Обработчик {os.getpid()} остановлен")
+
+# Главный процесс: слушающий сокет, запуск обработчиков fork(), замена обработчиков
+# при смене поколения базы (или по SIGHUP) и перезапуск аварийно завершившихся
+class PreforkServer:
+    def __init__(self, host='127.0.0.1', port=5000, workers=SERVE_WORKERS, threads=SERVE_THREADS,
+                 reload_interval=RELOAD_INTERVAL):
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.reload_interval = reload_interval
+        self.children = {}
+        self.generation = None
+        self.listener = None
+        self._reload = False
+        self._stop = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                _serve_worker(self.listener, self.host, self.port, self.threads)
+            except Exception as e:
+                logger.error(f"Ошибка обработчика {os.getpid()}: {str(e)}")
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = self.generation
+        return pid
+
+    def _reap(self):
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                self.children.clear()
+                return
+            if pid == 0:
+                return
+            generation = self.children.pop(pid, None)
+            if status and generation == self.generation and not self._stop:
+                logger.warning(f"Обработчик {pid} завершился аварийно (код {os.waitstatus_to_exitcode(status)}), запускается новый")
+
+    def _stop_children(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    # Плавная перезагрузка: новое состояние загружается заранее, новые обработчики начинают
+    # принимать подключения, и только затем старые получают RETIRE_SIGNAL и дорабатывают текущие
+    # запросы и задачи базы
+    def reload(self):
+        start = time.perf_counter()
+        old = list(self.children)
+        self.generation = preload(check_db=False)
+        for _ in range(self.workers):
+            self._spawn()
+        self._stop_children(old, RETIRE_SIGNAL)
+        logger.info(f"Поколение {self.generation}: обработчики заменены за {time.perf_counter() - start:.2f} с")
+
+    def serve_forever(self):
+        self.listener = socket.socket(socket.AF_INET6 if ':' in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((self.host, self.port))
+        self.listener.listen(LISTEN_BACKLOG)
+        self.listener.setblocking(False)
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_reload)
+        self.generation = preload()
+        logger.info(f"Сервер слушает http://{self.host}:{self.port}: обработчиков {self.workers}, "
+                    f"одновременных запросов в каждом {self.threads}, поколение {self.generation}")
+        last_check = time.monotonic()
+        try:
+            while not self._stop:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self.reload()
+                if time.monotonic() - last_check >= self.reload_interval:
+                    last_check = time.monotonic()
+                    generation = current_generation()
+                    if generation is not None and generation != self.generation:
+                        logger.info(f"Обнаружено новое поколение базы ({self.generation} -> {generation})")
+                        self.reload()
+                # Недостающие обработчики текущего поколения (при запуске и после аварийного завершения)
+                while sum(1 for generation in self.children.values() if generation == self.generation) < self.workers:
+                    self._spawn()
+                time.sleep(0.2)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        self._stop_children(list(self.children))
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT
+        while self.children and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self.children):
+            logger.warning(f"Обработчик {pid} не завершился за {GRACEFUL_TIMEOUT} с и будет остановлен принудительно")
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        self.children.clear()
+        if self.listener is not None:
+            self.listener.close()
+        logger.info("Сервер остановлен")
+
+    def _on_stop(self, signum, frame):
+        self._stop = True
+
+    def _on_reload(self, signum, frame):
+        self._reload = True
+
+def main(argv=None):
+    settings = run.load_settings()
+    parser = argparse.ArgumentParser(description='Многопроцессный сервер приложения (pre-fork)')
+    parser.add_argument('--host', default=settings.get('serve_host', '127.0.0.1'))
+    parser.add_argument('--port', type=int, default=settings.get('serve_port', 5000))
+    parser.add_argument('--workers', type=int, default=settings.get('serve_workers', SERVE_WORKERS))
+    parser.add_argument('--threads', type=int, default=settings.get('serve_threads', SERVE_THREADS),
+                        help='одновременных запросов в каждом обработчике')
+    parser.add_argument('--reload-interval', type=float, default=RELOAD_INTERVAL)
+    args = parser.parse_args(argv)
+    if args.workers < 1 or args.threads < 1:
+        parser.error('число обработчиков и потоков должно быть положительным')
+    if not hasattr(os, 'fork'):
+        # На Windows нет fork(): один процесс с ограниченным числом потоков
+        logger.warning("fork() недоступен, сервер запускается в одном процессе")
+        preload()
+        run.start_scheduler()
+        server = WorkerServer(args.host, args.port, run.app, None, args.threads)
+        logger.info(f"Сервер слушает http://{args.host}:{args.port}, одновременных запросов: {args.threads}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # Как при остановке обработчика: задачи отменяются до ожидания запросов (потоки SSE следят за ними)
+            run.scheduler.stop()
+            run.jobs.shutdown(GRACEFUL_TIMEOUT)
+            run.scheduler.join(GRACEFUL_TIMEOUT)
+            server.server_close()
+            logger.info("Сервер остановлен")
+        return 0
+    PreforkServer(args.host, args.port, args.workers, args.threads, args.reload_interval).serve_forever()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -7,16 +7,19 @@ import logging
 import json
 import webbrowser
 import pystray
-import requests
 from PIL import Image
 from flask import Flask, request, render_template
 from threading import Thread
+from index_builder import rebuild_database, GenerationHandle
+from registry_parser import RegistrySource
+from connection_info import ConnectionInfoCache
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+connection_info = ConnectionInfoCache()
 
 # Функция для нормализации текста
 def normalize_text(text):
@@ -28,58 +31,13 @@ def normalize_text(text):
 # Инициализация базы данных
 def init_db():
     try:
-        encodings = ['utf-8', 'windows-1251', 'latin1']
-        content = None
-        for encoding in encodings:
-            try:
-                with open('./fs_em.txt', 'r', encoding=encoding) as f:
-                    content = f.read()
-                logger.info(f"Успешно прочитан файл с кодировкой: {encoding}")
-                break
-            except UnicodeDecodeError:
-                logger.warning(f"Не удалось прочитать с кодировкой {encoding}, пробуем следующую")
-                continue
-        
-        if content is None:
-            raise Exception("Не удалось прочитать fs_em.txt: неподдерживающая кодировка")
-
-        entries = content.split('Экстремистский материал №')
-        materials = []
-        for entry in entries[1:]:
-            match = re.match(r'(\d+): (.+)', entry, re.DOTALL)
-            if match:
-                material_id = int(match.group(1))
-                material_text = match.group(2).strip()
-                date_match = re.search(r'\(решение .+? от ([0-9.]+)\)?', entry)
-                date = date_match.group(1) if date_match else "Не указана"
-                materials.append((material_id, date, material_text))
-            else:
-                logger.warning(f"Не удалось разобрать запись: {entry[:50]}...")
+        # Записи потоком идут из разбора fs_em.txt в загрузку (кодировка определяется по началу файла);
+        # новое поколение строится в теневой базе и атомарно подменяет рабочую
+        source = RegistrySource('txt', './fs_em.txt')
+        count = rebuild_database(source.materials(), source_hash=lambda: source.hash)['count']
         
         conn = sqlite3.connect('./restricted.db')
         cursor = conn.cursor()
-        
-        cursor.execute('DROP TABLE IF EXISTS restricted_materials_fts')
-        cursor.execute('''
-            CREATE VIRTUAL TABLE restricted_materials_fts USING fts5(id, date, material)
-        ''')
-        
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS restricted_materials (
-                id INTEGER PRIMARY KEY,
-                date TEXT,
-                material TEXT
-            )
-        ''')
-        
-        cursor.execute('DELETE FROM restricted_materials')
-        
-        for material_id, date, material_text in materials:
-            cursor.execute('INSERT INTO restricted_materials (id, date, material) VALUES (?, ?, ?)',
-                          (material_id, date, material_text))
-            cursor.execute('INSERT INTO restricted_materials_fts (id, date, material) VALUES (?, ?, ?)',
-                          (material_id, date, material_text))
-        
         cursor.execute('SELECT id, material FROM restricted_materials WHERE id = 5467')
         result = cursor.fetchone()
         if result:
@@ -88,24 +46,15 @@ def init_db():
         else:
             logger.error("ID 5467 НЕ найден в базе")
         
-        conn.commit()
         conn.close()
-        logger.info(f"База данных успешно инициализирована, загружено {len(materials)} записей")
+        logger.info(f"База данных успешно инициализирована, загружено {count} записей")
     except Exception as e:
         logger.error(f"Ошибка при инициализации базы данных: {str(e)}")
         raise
 
-# Получение публичного IP и страны
+# Получение публичного IP и страны из кэша, обновляемого фоновым потоком
 def get_public_ip_info():
-    try:
-        response = requests.get('http://ip-api.com/json/', timeout=5)
-        data = response.json()
-        if data['status'] == 'success':
-            return {'ip': data['query'], 'country': data['country']}
-        return {'ip': 'Не удалось определить', 'country': 'Не удалось определить'}
-    except Exception as e:
-        logger.error(f"Ошибка получения IP: {str(e)}")
-        return {'ip': 'Ошибка', 'country': 'Ошибка'}
+    return connection_info.get()
 
 # Управление плитками
 def load_tiles():
@@ -144,11 +93,10 @@ def index():
         query = normalize_text(request.form['query'])
         logger.info(f"Получен запрос: {query}")
         
-        conn = sqlite3.connect('./restricted.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT id, date, material FROM restricted_materials_fts WHERE material MATCH ?', (query,))
-        matches = cursor.fetchall()
-        conn.close()
+        with GenerationHandle() as handle:
+            cursor = handle.cursor()
+            cursor.execute('SELECT id, date, material FROM restricted_materials_fts WHERE material MATCH ?', (query,))
+            matches = cursor.fetchall()
         
         if matches:
             logger.warning(f"Найдено {len(matches)} запрещённых материалов для запроса '{query}'")
@@ -0,0 +1,59 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Максимальное число запросов, результаты которых хранятся в кэше
+VERDICT_CACHE_SIZE = 4096
+
+# LRU-кэш результатов проверки запросов. Ключ включает номер поколения индекса,
+# поэтому после init_db/update_db старые результаты больше не находятся, а при первой
+# записи нового поколения удаляются из кэша целиком
+class VerdictCache:
+    def __init__(self, max_entries=VERDICT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.generation = None
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, generation, query):
+        with self._lock:
+            verdict = self._entries.get((generation, query))
+            if verdict is None:
+                self.stats['misses'] += 1
+                return None
+            self._entries.move_to_end((generation, query))
+            self.stats['hits'] += 1
+            return verdict
+
+    def put(self, generation, query, verdict):
+        with self._lock:
+            if generation != self.generation:
+                if self.generation is not None and generation < self.generation:
+                    # Результат, вычисленный по уже заменённому поколению, не сохраняем
+                    return
+                if self._entries:
+                    logger.info(f"Поколение индекса {generation}: кэш результатов очищен ({len(self._entries)} записей)")
+                    self.stats['invalidations'] += 1
+                self._entries.clear()
+                self.generation = generation
+            self._entries[(generation, query)] = verdict
+            self._entries.move_to_end((generation, query))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def info(self):
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return dict(self.stats, size=len(self._entries), max_entries=self.max_entries, generation=self.generation,
+                        hit_rate=round(self.stats['hits'] / lookups, 4) if lookups else 0.0)
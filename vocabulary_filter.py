@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public License, v. 2.0.
+# If a copy of the MPL was not distributed with this file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+import math
+import time
+import random
+import string
+import sqlite3
+import hashlib
+import logging
+from memory_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Целевая доля ложных срабатываний фильтра
+FILTER_FP_RATE = 0.01
+# Число случайных слов вне словаря для замера фактической доли ложных срабатываний
+FILTER_PROBES = 5000
+
+# Фильтр Блума по словам корпуса: отвечает «слова точно нет» или «слово, возможно, есть».
+# Позиции битов — двойное хэширование двух 64-битных половин blake2b
+class VocabularyFilter:
+    def __init__(self, size, hashes, bits=None, items=0):
+        self.size = size
+        self.hashes = hashes
+        self.items = items
+        self.bits = bytearray(bits) if bits is not None else bytearray((size + 7) // 8)
+
+    @classmethod
+    def for_items(cls, items, fp_rate=FILTER_FP_RATE):
+        items = max(items, 1)
+        size = max(64, math.ceil(-items * math.log(fp_rate) / math.log(2) ** 2))
+        hashes = max(1, round(size / items * math.log(2)))
+        return cls(size, hashes)
+
+    def _positions(self, token):
+        digest = hashlib.blake2b(token.encode('utf-8'), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], 'little')
+        second = int.from_bytes(digest[8:], 'little') | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, token):
+        for position in self._positions(token):
+            self.bits[position >> 3] |= 1 << (position & 7)
+        self.items += 1
+
+    def might_contain(self, token):
+        bits = self.bits
+        return all(bits[position >> 3] & (1 << (position & 7)) for position in self._positions(token))
+
+    # Расчётная доля ложных срабатываний для текущего числа слов
+    def expected_fp_rate(self):
+        return (1 - math.exp(-self.hashes * self.items / self.size)) ** self.hashes
+
+    # Фактическая доля ложных срабатываний на случайных словах, которых нет в словаре
+    def measure_fp_rate(self, vocabulary, probes=FILTER_PROBES, seed=0):
+        rng = random.Random(seed)
+        alphabet = string.ascii_lowercase + 'абвгдежзийклмнопрстуфхцчшщъыьэюя'
+        tested = positives = 0
+        while tested < probes:
+            token = ''.join(rng.choice(alphabet) for _ in range(rng.randint(3, 12)))
+            if token in vocabulary:
+                continue
+            tested += 1
+            positives += self.might_contain(token)
+        return positives / tested if tested else 0.0
+
+    def info(self):
+        return {'size_bits': self.size, 'size_bytes': len(self.bits), 'hashes': self.hashes, 'items': self.items,
+                'expected_fp_rate': round(self.expected_fp_rate(), 6)}
+
+# Построение фильтра по всем словам материалов (токенизация как у FTS5 unicode61)
+def build_vocabulary_filter(texts, fp_rate=FILTER_FP_RATE):
+    start = time.perf_counter()
+    vocabulary = set()
+    for text in texts:
+        vocabulary.update(tokenize(text))
+    vocabulary_filter = VocabularyFilter.for_items(len(vocabulary), fp_rate)
+    for token in vocabulary:
+        vocabulary_filter.add(token)
+    measured = vocabulary_filter.measure_fp_rate(vocabulary)
+    logger.info(f"Фильтр словаря построен за {time.perf_counter() - start:.2f} с: {len(vocabulary)} слов, "
+                f"{len(vocabulary_filter.bits) / 1024:.1f} КиБ, {vocabulary_filter.hashes} хэш-функций, ложные срабатывания: "
+                f"расчётные {vocabulary_filter.expected_fp_rate():.4f}, фактические {measured:.4f}")
+    return vocabulary_filter, measured
+
+# Сохранение фильтра в базу вместе с материалами (в той же транзакции, что и поколение индекса)
+def save_vocabulary_filter(cursor, vocabulary_filter):
+    cursor.execute('CREATE TABLE IF NOT EXISTS vocabulary_filter (id INTEGER PRIMARY KEY CHECK (id = 1), '
+                   'size INTEGER, hashes INTEGER, items INTEGER, bits BLOB)')
+    cursor.execute('INSERT OR REPLACE INTO vocabulary_filter (id, size, hashes, items, bits) VALUES (1, ?, ?, ?, ?)',
+                   (vocabulary_filter.size, vocabulary_filter.hashes, vocabulary_filter.items, bytes(vocabulary_filter.bits)))
+
+# Перестроение фильтра по материалам в базе; возвращает фактическую долю ложных срабатываний
+def rebuild_vocabulary_filter(cursor, fp_rate=FILTER_FP_RATE):
+    cursor.execute('SELECT material FROM restricted_materials')
+    vocabulary_filter, measured = build_vocabulary_filter((material_text for material_text, in cursor.fetchall()), fp_rate)
+    save_vocabulary_filter(cursor, vocabulary_filter)
+    return measured
+
+# Загрузка фильтра из базы, None для баз без фильтра
+def load_vocabulary_filter(conn):
+    try:
+        row = conn.execute('SELECT size, hashes, items, bits FROM vocabulary_filter WHERE id = 1').fetchone()
+    except sqlite3.OperationalError:
+        return None
+    if row is None:
+        return None
+    size, hashes, items, bits = row
+    return VocabularyFilter(size, hashes, bits, items)